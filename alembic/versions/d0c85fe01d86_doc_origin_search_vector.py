@@ -0,0 +1,38 @@
+"""doc origin search vector
+
+Revision ID: d0c85fe01d86
+Revises: b9407988c7f9
+Create Date: 2026-10-18 12:10:41.318072
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd0c85fe01d86'
+down_revision: Union[str, None] = 'b9407988c7f9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('doc_origins', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed(
+            "to_tsvector('russian'::regconfig, coalesce(content, '')) || "
+            "to_tsvector('simple'::regconfig, coalesce(content, ''))",
+            persisted=True,
+        ),
+        nullable=True,
+    ))
+    op.create_index('ix_doc_origins_search_vector', 'doc_origins', ['search_vector'], unique=False, postgresql_using='gin')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_doc_origins_search_vector', table_name='doc_origins', postgresql_using='gin')
+    op.drop_column('doc_origins', 'search_vector')
@@ -0,0 +1,88 @@
+"""Redis commands and CPU spent per streamed document.
+
+Replays a synthetic LLM token stream of SSE lines against the Redis from the
+settings, twice. The old loop parsed each line, sent one ``RPUSH`` per token
+and logged it. The current one hands each token to ``DocStreamWriter`` with
+the configured flush thresholds. Both parse every line, as the OpenAI SDK
+does for the current producer. The old per-token log goes to stderr.
+
+    python -m benchmarks.stream_writes --tokens 3000 --rate 200 2>/dev/null
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from loguru import logger
+
+from src.application.redis import redis_client
+from src.application.streaming import DocStreamWriter, stream_key
+
+
+WORDS = "Архивный документ организации Хлопстроя заверило распоряжение № 1932 года".split()
+
+
+async def command_count() -> int:
+    stats = await redis_client.redis.info("commandstats")
+    return sum(v["calls"] for v in stats.values())
+
+
+def sse_line(token: str) -> str:
+    return "data: " + json.dumps({"choices": [{"delta": {"content": token}, "finish_reason": None}]})
+
+
+async def per_token(doc_version_id: str, lines: list[str], rate: float) -> None:
+    """The producer loop before coalescing."""
+    for line in lines:
+        data = json.loads(line.removeprefix("data: "))
+        chunk_text = data["choices"][0]["delta"]["content"]
+        await redis_client.rpush(stream_key(doc_version_id), chunk_text)
+        logger.info(chunk_text)
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await redis_client.rpush(stream_key(doc_version_id), "[close]")
+    await redis_client.srem("active_streams", doc_version_id)
+
+
+async def coalesced(doc_version_id: str, lines: list[str], rate: float) -> None:
+    writer = DocStreamWriter(doc_version_id)
+    for line in lines:
+        data = json.loads(line.removeprefix("data: "))
+        await writer.write(data["choices"][0]["delta"]["content"])
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await writer.close()
+
+
+async def run(producer, lines: list[str], rate: float) -> tuple[int, float, float]:
+    doc_version_id = str(uuid.uuid4())
+    commands = await command_count()
+    cpu, wall = time.process_time(), time.perf_counter()
+    await producer(doc_version_id, lines, rate)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    # INFO itself is counted once
+    commands = await command_count() - commands - 1
+    await redis_client.delete(stream_key(doc_version_id))
+    return commands, cpu, wall
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=3000)
+    parser.add_argument("--rate", type=float, default=0, help="tokens per second, 0 for no delay")
+    args = parser.parse_args()
+
+    lines = [sse_line(random.choice(WORDS) + " ") for _ in range(args.tokens)]
+    await redis_client.connect()
+    try:
+        for name, producer in (("per token", per_token), ("coalesced", coalesced)):
+            commands, cpu, wall = await run(producer, lines, args.rate)
+            print(f"{name:>10}: {commands:6d} redis commands, cpu {cpu * 1000:8.1f} ms, wall {wall * 1000:8.1f} ms")
+    finally:
+        await redis_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
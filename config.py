@@ -17,6 +17,17 @@ class Settings(BaseSettings):
     # Open AI
     OPENAI_TOKEN: str
     OPENAI_ASSISTANT_ID: str
+    OPENAI_STREAM_TIMEOUT: float = 600.0
+    OPENAI_STREAM_IDLE_TIMEOUT: float = 60.0
+    # Shared by all processes, per model: (requests per minute, tokens per minute)
+    OPENAI_RATE_LIMITS: dict[str, tuple[int, int]] = {
+        "gpt-4o": (500, 30000),
+        "gpt-4o-mini": (500, 200000),
+    }
+    # Reserved per call until the real usage is known
+    OPENAI_EST_COMPLETION_TOKENS: int = 1000
+    OPENAI_EST_IMAGE_TOKENS: int = 1105
+    OPENAI_LIMIT_WAITER_TTL: float = 5.0
     
 
     # JWT
@@ -29,18 +40,90 @@ class Settings(BaseSettings):
     AWS_SECRET_ACCESS_KEY: str
     AWS_DEFAULT_REGION: str
     AWS_BUCKET_NAME: str
+    # S3 requires at least 5 MiB for every part but the last
+    S3_MULTIPART_PART_SIZE: int = 8 * 1024 * 1024
+    S3_MAX_POOL_CONNECTIONS: int = 50
+    S3_KEEPALIVE_TIMEOUT: float = 60.0
+    # Cached presigned URLs are dropped this many seconds before they expire
+    S3_URL_CACHE_MARGIN: int = 300
     
+    # Image preprocessing before OCR
+    IMAGE_PREPROCESS_ENABLED: bool = True
+    IMAGE_PREPROCESS_WORKERS: int = 2
+    IMAGE_MAX_SIDE: int = 2048
+    IMAGE_MAX_SHORT_SIDE: int = 768
+    IMAGE_JPEG_QUALITY: int = 85
+    IMAGE_MAX_SKEW: float = 10.0
+    PDF_RENDER_DPI: int = 200
+    # Pages of one document recognised at the same time
+    OCR_PAGE_CONCURRENCY: int = 8
+    # Scans with a side of at least OCR_TILE_MIN_SIDE px are recognised in tiles
+    # sized to IMAGE_MAX_SIDE x IMAGE_MAX_SHORT_SIDE
+    OCR_TILING_ENABLED: bool = False
+    OCR_TILE_MIN_SIDE: int = 3000
+    OCR_TILE_OVERLAP: int = 128
+    OCR_TILE_CONCURRENCY: int = 8
+
     # REDIS
     REDIS_HOST: str
     REDIS_PORT: str
     REDIS_PASS: str
 
+    # Streaming
+    STREAM_HEARTBEAT_INTERVAL: float = 15.0
+    STREAM_QUEUE_SIZE: int = 256
+    STREAM_MAXLEN: int = 10000
+    STREAM_TTL: int = 86400
+    STREAM_FINISHED_TTL: int = 600
+    STREAM_FLUSH_BYTES: int = 256
+    STREAM_FLUSH_INTERVAL: float = 0.05
+
+    # Job queue, see worker.py
+    JOB_VISIBILITY_TIMEOUT: float = 120.0
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_RETRY_BACKOFF: float = 5.0
+    JOB_RETRY_BACKOFF_MAX: float = 300.0
+    JOB_POLL_INTERVAL: float = 0.5
+    JOB_OCR_CONCURRENCY: int = 4
+    JOB_REWRITE_CONCURRENCY: int = 8
+    JOB_SHUTDOWN_GRACE: float = 30.0
+
     # Google
     GOOGLE_AI_API_KEY: str
 
     # Pinecone
     PINECONE_API_KEY: str
     PINECONE_ENVIRONMENT: str
+    PINECONE_POOL_THREADS: int = 8
+    PINECONE_UPSERT_BATCH_SIZE: int = 100
+
+    # Vector store: "pinecone" or "local"
+    VECTOR_STORE: str = "pinecone"
+    LOCAL_VECTOR_STORE_PATH: str = "vector_store"
+    LOCAL_VECTOR_STORE_QUANTIZE: bool = False
+    LOCAL_VECTOR_STORE_IVF_MIN_SIZE: int = 50000
+    LOCAL_VECTOR_STORE_NPROBE: int = 8
+
+    # Embeddings
+    EMBED_MODEL_NAME: str = "models/embedding-001"
+    EMBED_BATCH_SIZE: int = 100
+    EMBED_BATCH_WINDOW: float = 0.2
+    EMBED_MAX_RETRIES: int = 3
+    EMBED_CHUNK_SIZE: int = 1500
+    EMBED_CHUNK_OVERLAP: int = 200
+    EMBED_CHUNK_QUERY_FACTOR: int = 5
+    VECTOR_SYNC_BATCH_SIZE: int = 100
+    VECTOR_SYNC_INTERVAL: float = 2.0
+    # Claimed entries become due again after the lease if their worker died
+    VECTOR_SYNC_LEASE: float = 300.0
+    VECTOR_SYNC_MAX_ATTEMPTS: int = 5
+    VECTOR_SYNC_BACKOFF: float = 30.0
+    VECTOR_SYNC_BACKOFF_MAX: float = 3600.0
+    QUERY_EMBED_CACHE_SIZE: int = 1024
+    QUERY_EMBED_CACHE_TTL: int = 7 * 24 * 3600
+    SEARCH_CACHE_TTL: int = 3600
+    SEARCH_LEXICAL_LIMIT: int = 50
+    SEARCH_VECTOR_TIMEOUT: float = 2.0
 
 
 settings = Settings()
@@ -2,14 +2,27 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from src.presentation import register_routers
-from src.presentation.utils import app_lifespan, lifespan_redis
+from src.infrastructure.lifespan import (
+    app_lifespan,
+    lifespan_redis,
+    lifespan_s3,
+    lifespan_stream_hub,
+    lifespan_vector_index,
+    lifespan_vector_sync,
+)
 from config import settings
 
 
 app = FastAPI(
     root_path="/api",
     lifespan=app_lifespan(
-        lifespans=[lifespan_redis],
+        lifespans=[
+            lifespan_redis,
+            lifespan_s3,
+            lifespan_stream_hub,
+            lifespan_vector_index,
+            lifespan_vector_sync,
+        ],
     ),
 )
 app.add_middleware(
@@ -1,15 +1,237 @@
-import json
+import asyncio
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Sequence
 
 from openai import AsyncOpenAI
 from loguru import logger
 
-from src.application.redis import redis_client
-from src.presentation.di import get_uow
+from src.application.ratelimit import Priority, openai_limiter, estimate_tokens
+from src.application.streaming import DocStreamWriter, read_stream_text, reset_stream
+from src.infrastructure.database import get_uow
 from config import settings
 
 
 client = AsyncOpenAI(api_key=settings.OPENAI_TOKEN)
 
+CONTINUE_PROMPT = (
+    "Your answer above was cut off. Continue it exactly where it stops, "
+    "without repeating any of it and without comments."
+)
+
+
+
+
+@dataclass
+class StreamStats:
+    started_at: float = field(default_factory=time.perf_counter)
+    first_token_at: float | None = None
+    finished_at: float | None = None
+    chunks: int = 0
+    chars: int = 0
+    finish_reason: str | None = None
+    total_tokens: int | None = None
+
+    @property
+    def time_to_first_token(self) -> float | None:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+
+class StreamSink:
+    """Receives the deltas of a streamed completion, see ``stream_completion``."""
+
+    async def on_delta(self, text: str) -> None:
+        pass
+
+    async def on_finish(self, text: str, stats: StreamStats) -> None:
+        pass
+
+    async def on_error(self, exc: BaseException, stats: StreamStats) -> None:
+        pass
+
+
+class DocStreamSink(StreamSink):
+    """Forwards deltas to the document stream read by ``/chat/streaming``.
+
+    Every worker's ``StreamHub`` picks the chunks up from there, so this sink
+    also serves as the WebSocket fan-out.
+    """
+
+    def __init__(self, doc_version_id: str, offset: int = 0) -> None:
+        self.writer = DocStreamWriter(doc_version_id, offset)
+
+    async def on_delta(self, text: str) -> None:
+        await self.writer.write(text)
+
+    async def on_finish(self, text: str, stats: StreamStats) -> None:
+        await self.writer.close()
+
+    async def on_error(self, exc: BaseException, stats: StreamStats) -> None:
+        # Keep everything produced so far, a retry continues from it
+        await self.writer.flush()
+
+
+class DocVersionSink(StreamSink):
+    """Stores the generated text in the ``DocVersion`` row."""
+
+    def __init__(self, doc_version_id: str) -> None:
+        self.doc_version_id = doc_version_id
+
+    async def on_finish(self, text: str, stats: StreamStats) -> None:
+        uow = await get_uow()
+        async with uow:
+            await uow.chat_repo.edit_doc_version(self.doc_version_id, text)
+
+
+class MetricsSink(StreamSink):
+    def __init__(self, task: str, key: str) -> None:
+        self.task = task
+        self.key = key
+
+    async def on_finish(self, text: str, stats: StreamStats) -> None:
+        logger.info(
+            f"{self.task} {self.key} finished: ttft={stats.time_to_first_token or 0:.2f}s "
+            f"duration={stats.duration:.2f}s chunks={stats.chunks} chars={stats.chars} "
+            f"tokens={stats.total_tokens} finish_reason={stats.finish_reason}"
+        )
+
+    async def on_error(self, exc: BaseException, stats: StreamStats) -> None:
+        logger.error(
+            f"{self.task} {self.key} failed after {stats.duration:.2f}s "
+            f"({stats.chars} chars): {exc!r}"
+        )
+
+
+async def stream_completion(
+    sinks: list[StreamSink],
+    prefix: str = "",
+    priority: Priority = Priority.BULK,
+    timeout: float = settings.OPENAI_STREAM_TIMEOUT,
+    idle_timeout: float = settings.OPENAI_STREAM_IDLE_TIMEOUT,
+    **kwargs: Any,
+) -> str:
+    """Run a streamed chat completion and feed its deltas to ``sinks``.
+
+    ``kwargs`` go to ``client.chat.completions.create``. The whole call is
+    limited by ``timeout`` seconds and each wait for the next chunk (including
+    the first one) by ``idle_timeout``. On failure or cancellation every sink
+    gets ``on_error`` and the exception is re-raised. ``prefix`` is text
+    generated earlier that this completion continues; it is not sent to the
+    sinks again but is part of the text they get in ``on_finish``. The call
+    waits for the shared rate limit first, see ``openai_limiter``; time spent
+    there does not count towards the timeouts.
+
+    Returns:
+        str: The generated text, starting with ``prefix``.
+    """
+    reserved = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    await openai_limiter.acquire(kwargs["model"], reserved, priority)
+    kwargs.setdefault("stream_options", {"include_usage": True})
+    stats = StreamStats()
+    deadline = stats.started_at + timeout
+    parts = [prefix]
+    response = None
+    try:
+        response = await asyncio.wait_for(
+            client.chat.completions.create(stream=True, **kwargs), idle_timeout
+        )
+        chunks = aiter(response)
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"Completion did not finish in {timeout}s")
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), min(idle_timeout, remaining))
+            except StopAsyncIteration:
+                break
+            if chunk.usage is not None:
+                stats.total_tokens = chunk.usage.total_tokens
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                if stats.first_token_at is None:
+                    stats.first_token_at = time.perf_counter()
+                stats.chunks += 1
+                stats.chars += len(choice.delta.content)
+                parts.append(choice.delta.content)
+                for sink in sinks:
+                    await sink.on_delta(choice.delta.content)
+            if choice.finish_reason:
+                # Not the end yet: the usage chunk follows
+                stats.finish_reason = choice.finish_reason
+    except BaseException as e:
+        stats.finished_at = time.perf_counter()
+        for sink in sinks:
+            try:
+                await sink.on_error(e, stats)
+            except Exception as sink_error:
+                logger.error(f"Stream sink {sink!r} failed on error: {sink_error}")
+        raise
+    finally:
+        if response is not None:
+            await response.close()
+        await openai_limiter.settle(kwargs["model"], reserved, stats.total_tokens or reserved)
+    stats.finished_at = time.perf_counter()
+    text = "".join(parts)
+    for sink in sinks:
+        await sink.on_finish(text, stats)
+    return text
+
+
+async def stream_doc_completion(
+    doc_version_id: str,
+    sinks: list[StreamSink],
+    messages: list[dict[str, Any]],
+    **kwargs: Any,
+) -> str:
+    """``stream_completion`` into the document stream of ``doc_version_id``.
+
+    The stream is the checkpoint: it is flushed every ``STREAM_FLUSH_BYTES``
+    or ``STREAM_FLUSH_INTERVAL`` and outlives the worker, so when a job is
+    retried after a crash the model is asked to continue the text already in
+    the stream and readers get it as one uninterrupted text. A stream that
+    was closed with text in it is not generated again at all.
+    """
+    checkpoint = await read_stream_text(doc_version_id)
+    prefix, closed = checkpoint or ("", False)
+    if closed and prefix:
+        logger.info(f"Stream {doc_version_id} is already finished, reusing its {len(prefix)} chars")
+        for sink in sinks:
+            await sink.on_finish(prefix, StreamStats())
+        return prefix
+    if checkpoint is None or closed:
+        # Trimmed or closed by a failed job: start over
+        await reset_stream(doc_version_id)
+    elif prefix:
+        logger.info(f"Stream {doc_version_id} resumes after {len(prefix)} chars")
+        messages = [
+            *messages,
+            {"role": "assistant", "content": prefix},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+    return await stream_completion(
+        sinks=[DocStreamSink(doc_version_id, len(prefix)), *sinks],
+        prefix=prefix,
+        messages=messages,
+        **kwargs,
+    )
+
+
+async def create_completion(priority: Priority, **kwargs: Any):
+    """``client.chat.completions.create`` behind the shared rate limit."""
+    reserved = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    await openai_limiter.acquire(kwargs["model"], reserved, priority)
+    response = await client.chat.completions.create(**kwargs)
+    await openai_limiter.settle(kwargs["model"], reserved, response.usage.total_tokens)
+    return response
 
 
 tools = [
@@ -31,7 +253,8 @@ tools = [
 
 async def generate_answer(messages: list[dict[str, str]]) -> tuple[str, bool]:
     logger.info(f"generating answer: {messages}")
-    response = await client.chat.completions.create(
+    response = await create_completion(
+        Priority.INTERACTIVE,
         model="gpt-4o-mini",
         messages=messages,
         tools=tools,
@@ -45,7 +268,8 @@ async def generate_answer(messages: list[dict[str, str]]) -> tuple[str, bool]:
     
 
 async def generate_title(content: str) -> str:
-    response = await client.chat.completions.create(
+    response = await create_completion(
+        Priority.BULK,
         model="gpt-4o-mini",
         messages=[
             {
@@ -61,8 +285,13 @@ async def generate_title(content: str) -> str:
     return response.choices[0].message.content
 
 async def rewrite_doc(content: str, prompt: str, doc_version_id: str) -> str:
-    response = await client.chat.completions.create(
-        stream=True,
+    return await stream_doc_completion(
+        doc_version_id,
+        sinks=[
+            DocVersionSink(doc_version_id),
+            MetricsSink("rewrite", doc_version_id),
+        ],
+        priority=Priority.REWRITE,
         model="gpt-4o-mini",
         messages=[
             {
@@ -77,33 +306,26 @@ async def rewrite_doc(content: str, prompt: str, doc_version_id: str) -> str:
             }
         ],
     )
-    full_text = ""
-    async for text in response.response.aiter_lines():
-        if not text:
-            continue
-        data = text.removeprefix("data: ")
-        if data.strip() == "[DONE]":
-            break
-        data = json.loads(text.removeprefix("data: "))
-        if data["choices"][0]["finish_reason"]:
-            break
-        chunk_text = data["choices"][0]["delta"]["content"]
-        await redis_client.rpush(f"stream:{doc_version_id}", chunk_text)
-        logger.info(chunk_text)
-        full_text += chunk_text
-    await redis_client.rpush(f"stream:{doc_version_id}", "[close]")
-    await redis_client.srem("active_streams", doc_version_id)
-    
-    uow = await get_uow()
-    async with uow:
-        await uow.chat_repo.edit_doc_version(doc_version_id, full_text)
-        
-    return full_text
-
-async def ocr(fileurl: str, doc_version_id: str) -> str:
-    response = await client.chat.completions.create(
-        stream_options={"include_usage": False},
-        stream=True,
+
+async def ocr(
+    fileurl: str,
+    doc_version_id: str | None = None,
+    key: str | None = None,
+    sinks: Sequence[StreamSink] = (),
+) -> str:
+    """Recognise the image at ``fileurl``.
+
+    The text is streamed to the document stream of ``doc_version_id`` if one
+    is given, resuming an interrupted earlier attempt, and to ``sinks``;
+    ``key`` names the job in the metrics log.
+    """
+    sinks = [*sinks, MetricsSink("ocr", key or doc_version_id)]
+    if doc_version_id:
+        complete = partial(stream_doc_completion, doc_version_id)
+    else:
+        complete = stream_completion
+    return await complete(
+        sinks=sinks,
         model="gpt-4o",
         messages=[
             {
@@ -134,20 +356,3 @@ async def ocr(fileurl: str, doc_version_id: str) -> str:
             }
         ],
     )
-    full_text = ""
-    async for text in response.response.aiter_lines():
-        if not text:
-            continue
-        data = text.removeprefix("data: ")
-        if data.strip() == "[DONE]":
-            break
-        data = json.loads(text.removeprefix("data: "))
-        if data["choices"][0]["finish_reason"]:
-            break
-        chunk_text = data["choices"][0]["delta"]["content"]
-        await redis_client.rpush(f"stream:{doc_version_id}", chunk_text)
-        logger.info(chunk_text)
-        full_text += chunk_text
-    await redis_client.rpush(f"stream:{doc_version_id}", "[close]")
-    await redis_client.srem("active_streams", doc_version_id)
-    return full_text
@@ -0,0 +1,290 @@
+"""Durable job queue in Redis.
+
+Web workers only ``enqueue``; the jobs run in ``worker.py``. Keys:
+
+- ``jobs:{type}:ready`` - ids of the jobs waiting to run, oldest at the tail,
+- ``jobs:data`` / ``jobs:attempts`` - job payload and claim count by id,
+- ``jobs:running`` - ids of claimed jobs scored by their visibility deadline,
+- ``jobs:delayed`` - ids of failed jobs scored by the time of their next attempt,
+- ``jobs:dead`` - payloads of the jobs that used up their attempts.
+
+Claiming moves a job from its ready list to ``jobs:running`` in one Lua
+script. The worker keeps pushing the deadline forward while the job runs; if
+the worker dies, the deadline passes and the reaper hands the job out again,
+so every job runs at least once.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from loguru import logger
+
+from src.application.redis import RedisClient, redis_client
+from config import settings
+
+
+JOBS_DATA = "jobs:data"
+JOBS_ATTEMPTS = "jobs:attempts"
+JOBS_RUNNING = "jobs:running"
+JOBS_DELAYED = "jobs:delayed"
+JOBS_DEAD = "jobs:dead"
+
+
+def ready_key(job_type: str) -> str:
+    return f"jobs:{job_type}:ready"
+
+
+# KEYS: ready list, running zset, attempts hash; ARGV: visibility deadline
+CLAIM_SCRIPT = """
+local id = redis.call('RPOP', KEYS[1])
+if not id then
+    return nil
+end
+redis.call('ZADD', KEYS[2], ARGV[1], id)
+local attempts = redis.call('HINCRBY', KEYS[3], id, 1)
+return {id, attempts}
+"""
+
+# KEYS: running zset, delayed zset, data hash; ARGV: now, batch size
+REAP_SCRIPT = """
+local moved = 0
+for _, key in ipairs({KEYS[1], KEYS[2]}) do
+    local ids = redis.call('ZRANGEBYSCORE', key, '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+    for _, id in ipairs(ids) do
+        redis.call('ZREM', key, id)
+        local data = redis.call('HGET', KEYS[3], id)
+        if data then
+            redis.call('LPUSH', 'jobs:' .. cjson.decode(data)['type'] .. ':ready', id)
+            moved = moved + 1
+        end
+    end
+end
+return moved
+"""
+
+
+@dataclass
+class Job:
+    id: str
+    type: str
+    kwargs: dict[str, Any]
+    enqueued_at: float
+    attempts: int = 0
+
+    def dump(self) -> str:
+        return json.dumps(dict(id=self.id, type=self.type, kwargs=self.kwargs, enqueued_at=self.enqueued_at))
+
+
+class JobQueue:
+    def __init__(self, redis: RedisClient) -> None:
+        self._redis = redis
+        self._claim_script = None
+        self._reap_script = None
+
+    async def enqueue(self, job_type: str, **kwargs: Any) -> str:
+        """Add a job; ``kwargs`` must be JSON serialisable. Returns the job id."""
+        job = Job(id=uuid.uuid4().hex, type=job_type, kwargs=kwargs, enqueued_at=time.time())
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(JOBS_DATA, job.id, job.dump())
+        pipe.lpush(ready_key(job_type), job.id)
+        await pipe.execute()
+        logger.info(f"Job {job.type} {job.id} enqueued")
+        return job.id
+
+    async def claim(self, job_type: str, visibility_timeout: float) -> Optional[Job]:
+        if self._claim_script is None:
+            self._claim_script = self._redis.register_script(CLAIM_SCRIPT)
+        claimed = await self._claim_script(
+            keys=[ready_key(job_type), JOBS_RUNNING, JOBS_ATTEMPTS],
+            args=[time.time() + visibility_timeout],
+        )
+        if claimed is None:
+            return None
+        job_id, attempts = claimed[0].decode(), int(claimed[1])
+        data = await self._redis.redis.hget(JOBS_DATA, job_id)
+        if data is None:
+            # Acked by a previous holder whose visibility had expired
+            await self._redis.redis.zrem(JOBS_RUNNING, job_id)
+            return None
+        job = Job(**json.loads(data))
+        job.attempts = attempts
+        return job
+
+    async def extend(self, job: Job, visibility_timeout: float) -> None:
+        await self._redis.redis.zadd(JOBS_RUNNING, {job.id: time.time() + visibility_timeout}, xx=True)
+
+    async def ack(self, job: Job) -> None:
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.zrem(JOBS_RUNNING, job.id)
+        pipe.hdel(JOBS_DATA, job.id)
+        pipe.hdel(JOBS_ATTEMPTS, job.id)
+        await pipe.execute()
+
+    async def retry(self, job: Job, delay: float) -> None:
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.zrem(JOBS_RUNNING, job.id)
+        pipe.zadd(JOBS_DELAYED, {job.id: time.time() + delay})
+        await pipe.execute()
+
+    async def release(self, job: Job) -> None:
+        """Put a job that was interrupted by shutdown back without counting the attempt."""
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.zrem(JOBS_RUNNING, job.id)
+        pipe.hincrby(JOBS_ATTEMPTS, job.id, -1)
+        pipe.rpush(ready_key(job.type), job.id)
+        await pipe.execute()
+
+    async def bury(self, job: Job, error: str) -> None:
+        """Move a job to the dead-letter list."""
+        dead = json.loads(job.dump()) | dict(attempts=job.attempts, error=error, failed_at=time.time())
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.zrem(JOBS_RUNNING, job.id)
+        pipe.hdel(JOBS_DATA, job.id)
+        pipe.hdel(JOBS_ATTEMPTS, job.id)
+        pipe.lpush(JOBS_DEAD, json.dumps(dead))
+        await pipe.execute()
+
+    async def reap(self, batch_size: int = 100) -> int:
+        """Requeue jobs whose visibility expired and failed jobs whose delay is over."""
+        if self._reap_script is None:
+            self._reap_script = self._redis.register_script(REAP_SCRIPT)
+        return int(await self._reap_script(
+            keys=[JOBS_RUNNING, JOBS_DELAYED, JOBS_DATA], args=[time.time(), batch_size]
+        ))
+
+    async def requeue_dead(self) -> int:
+        """Enqueue every dead-lettered job again with a fresh attempt count."""
+        count = 0
+        while (data := await self._redis.redis.rpop(JOBS_DEAD)) is not None:
+            dead = json.loads(data)
+            await self.enqueue(dead["type"], **dead["kwargs"])
+            count += 1
+        return count
+
+
+@dataclass
+class JobType:
+    handler: Callable[..., Awaitable[Any]]
+    concurrency: int = 1
+    max_attempts: int = settings.JOB_MAX_ATTEMPTS
+    # Called with the job kwargs after the last failed attempt
+    on_dead: Optional[Callable[..., Awaitable[None]]] = None
+
+
+class JobWorker:
+    """Runs ``concurrency`` consumers for every registered job type."""
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        job_types: dict[str, JobType],
+        visibility_timeout: float = settings.JOB_VISIBILITY_TIMEOUT,
+        poll_interval: float = settings.JOB_POLL_INTERVAL,
+        backoff: float = settings.JOB_RETRY_BACKOFF,
+        max_backoff: float = settings.JOB_RETRY_BACKOFF_MAX,
+    ) -> None:
+        self.queue = queue
+        self.job_types = job_types
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._stopping = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks.append(asyncio.create_task(self._reap_loop()))
+        for name, job_type in self.job_types.items():
+            for _ in range(job_type.concurrency):
+                self._tasks.append(asyncio.create_task(self._consume(name, job_type)))
+        logger.info(
+            "Job worker started: "
+            + ", ".join(f"{name} x{job_type.concurrency}" for name, job_type in self.job_types.items())
+        )
+
+    async def stop(self, grace: float = settings.JOB_SHUTDOWN_GRACE) -> None:
+        """Stop claiming, give running jobs ``grace`` seconds, then release the rest."""
+        self._stopping.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=grace)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _reap_loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                moved = await self.queue.reap()
+                if moved:
+                    logger.info(f"Requeued {moved} expired or delayed jobs")
+            except Exception as e:
+                logger.error(f"Reaping jobs failed: {e!r}")
+            with suppress(TimeoutError):
+                await asyncio.wait_for(self._stopping.wait(), 1.0)
+
+    async def _consume(self, name: str, job_type: JobType) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = await self.queue.claim(name, self.visibility_timeout)
+            except Exception as e:
+                logger.error(f"Claiming {name} job failed: {e!r}")
+                job = None
+            if job is None:
+                with suppress(TimeoutError):
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                continue
+            await self._run(job, job_type)
+
+    async def _run(self, job: Job, job_type: JobType) -> None:
+        if job.attempts > job_type.max_attempts:
+            # Claimed too often without an ack: it keeps killing its worker
+            await self._bury(job, job_type, "visibility timeout expired on every attempt")
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        started = time.perf_counter()
+        try:
+            await job_type.handler(**job.kwargs)
+        except asyncio.CancelledError:
+            await self.queue.release(job)
+            raise
+        except Exception as e:
+            if job.attempts >= job_type.max_attempts:
+                await self._bury(job, job_type, repr(e))
+            else:
+                delay = min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff) * random.uniform(0.8, 1.2)
+                logger.warning(
+                    f"Job {job.type} {job.id} attempt {job.attempts} failed, retrying in {delay:.0f}s: {e!r}"
+                )
+                await self.queue.retry(job, delay)
+        else:
+            await self.queue.ack(job)
+            logger.info(
+                f"Job {job.type} {job.id} done in {time.perf_counter() - started:.2f}s "
+                f"(attempt {job.attempts}, {time.time() - job.enqueued_at:.2f}s since enqueue)"
+            )
+        finally:
+            heartbeat.cancel()
+
+    async def _bury(self, job: Job, job_type: JobType, error: str) -> None:
+        logger.error(f"Job {job.type} {job.id} failed after {job.attempts} attempts: {error}")
+        await self.queue.bury(job, error)
+        if job_type.on_dead is not None:
+            try:
+                await job_type.on_dead(**job.kwargs)
+            except Exception as e:
+                logger.error(f"Cleanup of dead job {job.id} failed: {e!r}")
+
+    async def _heartbeat(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                await self.queue.extend(job, self.visibility_timeout)
+            except Exception as e:
+                logger.error(f"Extending job {job.id} failed: {e!r}")
+
+
+job_queue = JobQueue(redis_client)
@@ -0,0 +1,431 @@
+"""In-process vector store, an alternative to Pinecone.
+
+Vectors are L2-normalised and kept in a float32 matrix in a memory-mapped
+file (``vectors.f32``), so cosine similarity is a single matrix product.
+Ids and metadata are appended to ``index.jsonl``; both files are written
+incrementally on every upsert.
+
+Several processes (uvicorn workers) can share a store: every write holds an
+exclusive ``flock`` on ``lock`` and every read a shared one, and before either
+a process applies the ``index.jsonl`` entries other processes appended since
+it last looked, so row numbers are allocated from one consistent view. When
+the log is rewritten (compaction, ``delete_all``) the id in ``epoch`` changes
+and the other processes reload the store.
+
+Optionally the store keeps an int8 copy of the matrix in memory for the scan
+and re-ranks the best candidates with the float32 rows. Collections of at
+least ``ivf_min_size`` vectors get an IVF coarse partition (k-means
+centroids) and a query scans only the ``nprobe`` closest partitions.
+"""
+import fcntl
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
+
+from src.application.vectordb import VectorStore
+
+
+class LocalVectorStore(VectorStore):
+    initial_capacity = 1024
+    scan_block = 65536
+    rerank_factor = 4
+    kmeans_iterations = 8
+    kmeans_sample = 65536
+
+    def __init__(
+        self,
+        path: str,
+        dimension: int = 768,
+        quantize: bool = False,
+        ivf_min_size: int = 50000,
+        nprobe: int = 8,
+    ) -> None:
+        self.path = path
+        self.dimension = dimension
+        self.quantize = quantize
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._matrix: Optional[np.memmap] = None
+        self._count = 0
+        self._rows: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._metadata: List[Optional[dict]] = []
+        # int8 copy and per-row scales, see ``quantize``
+        self._quantized: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        # IVF partition
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments: Optional[np.ndarray] = None
+        self._lists: List[List[int]] = []
+        self._list_arrays: Dict[int, np.ndarray] = {}
+        self._ivf_built_size = 0
+        # How much of ``index.jsonl`` this process has applied
+        self._epoch = ""
+        self._log_offset = 0
+        self._log_lines = 0
+        self._lock_file = None
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors.f32")
+
+    @property
+    def _log_path(self) -> str:
+        return os.path.join(self.path, "index.jsonl")
+
+    @property
+    def _epoch_path(self) -> str:
+        return os.path.join(self.path, "epoch")
+
+    def _read_epoch(self) -> str:
+        try:
+            with open(self._epoch_path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _bump_epoch(self) -> None:
+        self._epoch = uuid.uuid4().hex
+        with open(self._epoch_path, "w") as f:
+            f.write(self._epoch)
+
+    def connect(self) -> None:
+        with self._lock:
+            if self._matrix is not None:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self._lock_file = open(os.path.join(self.path, "lock"), "a")
+            with self._file_lock(exclusive=True):
+                self._reload()
+                if self._log_lines > 2 * self._count:
+                    self._compact_log()
+            logger.info(f"Local vector store {self.path}: {self._count} vectors")
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool) -> Iterator[None]:
+        """Lock the store for all processes; taken with ``self._lock`` held."""
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _reset(self) -> None:
+        self._matrix = None
+        self._count = 0
+        self._rows.clear()
+        self._ids.clear()
+        self._metadata.clear()
+        self._quantized = None
+        self._scales = None
+        self._centroids = None
+        self._assignments = None
+        self._lists = []
+        self._list_arrays.clear()
+        self._ivf_built_size = 0
+        self._log_offset = 0
+        self._log_lines = 0
+
+    def _reload(self) -> None:
+        self._reset()
+        self._epoch = self._read_epoch()
+        self._read_log()
+        self._open_matrix(max(self._count, self.initial_capacity))
+        self._rebuild_derived()
+
+    def _read_log(self) -> List[int]:
+        """Apply the log entries after ``_log_offset``; return the rows they touched."""
+        rows = []
+        if not os.path.exists(self._log_path):
+            return rows
+        with open(self._log_path) as f:
+            f.seek(self._log_offset)
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    row = self._clear_row(entry["id"])
+                else:
+                    row = entry["row"]
+                    self._set_row(entry["id"], row, entry["metadata"])
+                if row is not None:
+                    rows.append(row)
+                self._log_lines += 1
+            self._log_offset = f.tell()
+        return rows
+
+    def _refresh(self) -> None:
+        """Catch up with the writes of other processes; called under the file lock."""
+        if self._read_epoch() != self._epoch:
+            # Compacted or cleared by another process
+            self._reload()
+            return
+        try:
+            size = os.path.getsize(self._log_path)
+        except FileNotFoundError:
+            return
+        if size < self._log_offset:
+            self._reload()
+            return
+        if size == self._log_offset:
+            return
+        rows = self._read_log()
+        self._ensure_capacity(self._count)
+        if rows:
+            rows = np.unique(np.asarray(rows))
+            self._update_derived(rows, np.asarray(self._matrix[rows]))
+
+    def _append_log(self, entries: List[dict]) -> None:
+        with open(self._log_path, "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            self._log_offset = f.tell()
+            self._log_lines += len(entries)
+
+    async def upsert(self, vectors: List[tuple]) -> None:
+        await run_in_threadpool(self._upsert, vectors)
+
+    async def query(self, vector: List[float], top_k: int = 9, include_metadata: bool = True) -> Dict[str, Any]:
+        return await run_in_threadpool(self._query, vector, top_k, include_metadata)
+
+    async def delete(self, ids: List[str]) -> None:
+        await run_in_threadpool(self._delete, ids)
+
+    async def delete_all(self) -> None:
+        await run_in_threadpool(self._delete_all)
+
+    def _upsert(self, vectors: List[tuple]) -> None:
+        self.connect()
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            values = self._normalize(np.asarray([v[1] for v in vectors], dtype=np.float32))
+            rows = []
+            for item in vectors:
+                doc_id, metadata = item[0], item[2] if len(item) > 2 else None
+                row = self._rows.get(doc_id, self._count)
+                self._set_row(doc_id, row, metadata)
+                rows.append(row)
+            self._ensure_capacity(self._count)
+            rows = np.asarray(rows)
+            self._matrix[rows] = values
+            self._matrix.flush()
+            self._append_log([
+                {"id": item[0], "row": int(row), "metadata": self._metadata[row]}
+                for item, row in zip(vectors, rows)
+            ])
+            self._update_derived(rows, values)
+
+    def _query(self, vector: List[float], top_k: int, include_metadata: bool) -> Dict[str, Any]:
+        self.connect()
+        query = self._normalize(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        with self._lock, self._file_lock(exclusive=False):
+            self._refresh()
+            if self._count == 0:
+                return {"matches": []}
+            candidates = self._probe(query)
+            if self.quantize:
+                # Coarse scan on int8, exact scores for the best few
+                coarse = self._scan(query, candidates, quantized=True)
+                keep = self._top(coarse, top_k * self.rerank_factor)
+                candidates = keep if candidates is None else candidates[keep]
+            scores = self._scan(query, candidates, quantized=False)
+            best = self._top(scores, top_k + self._count - len(self._rows))
+            rows = best if candidates is None else candidates[best]
+            matches = [
+                {
+                    "id": self._ids[row],
+                    "score": float(score),
+                    "metadata": self._metadata[row] if include_metadata else None,
+                }
+                for row, score in zip(rows.tolist(), scores[best].tolist())
+                if self._ids[row] is not None
+            ]
+            return {"matches": matches[:top_k]}
+
+    def _delete(self, ids: List[str]) -> None:
+        """Zero the rows of ``ids``; the rows stay allocated as tombstones."""
+        self.connect()
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            rows = [self._clear_row(doc_id) for doc_id in ids]
+            rows = np.asarray([row for row in rows if row is not None])
+            if not len(rows):
+                return
+            values = np.zeros((len(rows), self.dimension), dtype=np.float32)
+            self._matrix[rows] = values
+            self._matrix.flush()
+            self._append_log([{"id": doc_id, "deleted": True} for doc_id in ids])
+            if self.quantize:
+                self._quantize_rows(rows, values)
+
+    def _delete_all(self) -> None:
+        self.connect()
+        with self._lock, self._file_lock(exclusive=True):
+            self._matrix = None
+            for path in (self._vectors_path, self._log_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._reload()
+            self._bump_epoch()
+
+    def _set_row(self, doc_id: str, row: int, metadata: Optional[dict]) -> None:
+        self._rows[doc_id] = row
+        if row >= len(self._ids):
+            self._ids.extend([None] * (row + 1 - len(self._ids)))
+            self._metadata.extend([None] * (row + 1 - len(self._metadata)))
+        self._ids[row] = doc_id
+        self._metadata[row] = metadata
+        self._count = max(self._count, row + 1)
+
+    def _clear_row(self, doc_id: str) -> Optional[int]:
+        row = self._rows.pop(doc_id, None)
+        if row is not None:
+            self._ids[row] = None
+            self._metadata[row] = None
+        return row
+
+    def _open_matrix(self, capacity: int) -> None:
+        size = capacity * self.dimension * 4
+        if not os.path.exists(self._vectors_path) or os.path.getsize(self._vectors_path) < size:
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(size)
+        capacity = os.path.getsize(self._vectors_path) // (self.dimension * 4)
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimension))
+
+    def _ensure_capacity(self, count: int) -> None:
+        capacity = self._matrix.shape[0]
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        self._matrix.flush()
+        self._matrix = None
+        self._open_matrix(capacity)
+        if self._quantized is not None:
+            self._quantized = np.resize(self._quantized, (capacity, self.dimension))
+            self._scales = np.resize(self._scales, capacity)
+        if self._assignments is not None:
+            assignments = np.full(capacity, -1, dtype=np.int32)
+            assignments[:len(self._assignments)] = self._assignments
+            self._assignments = assignments
+
+    def _compact_log(self) -> None:
+        tmp_path = self._log_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for row in range(self._count):
+                if self._ids[row] is not None:
+                    f.write(json.dumps({"id": self._ids[row], "row": row, "metadata": self._metadata[row]}) + "\n")
+            self._log_offset = f.tell()
+        os.replace(tmp_path, self._log_path)
+        self._log_lines = len(self._rows)
+        self._bump_epoch()
+
+    @staticmethod
+    def _normalize(values: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        return values / np.where(norms == 0, 1, norms)
+
+    def _rebuild_derived(self) -> None:
+        capacity = self._matrix.shape[0]
+        if self.quantize:
+            self._quantized = np.zeros((capacity, self.dimension), dtype=np.int8)
+            self._scales = np.zeros(capacity, dtype=np.float32)
+            for start in range(0, self._count, self.scan_block):
+                rows = np.arange(start, min(start + self.scan_block, self._count))
+                self._quantize_rows(rows, np.asarray(self._matrix[rows]))
+        if self._count >= self.ivf_min_size:
+            self._build_ivf()
+
+    def _update_derived(self, rows: np.ndarray, values: np.ndarray) -> None:
+        if self.quantize:
+            self._quantize_rows(rows, values)
+        if self._centroids is None:
+            if self._count >= self.ivf_min_size:
+                self._build_ivf()
+        elif self._count >= 2 * self._ivf_built_size:
+            # The partition was trained on half the data, retrain it
+            self._build_ivf()
+        else:
+            self._assign(rows, values)
+
+    def _quantize_rows(self, rows: np.ndarray, values: np.ndarray) -> None:
+        scales = np.abs(values).max(axis=1) / 127
+        scales[scales == 0] = 1
+        self._quantized[rows] = np.round(values / scales[:, None]).astype(np.int8)
+        self._scales[rows] = scales
+
+    def _build_ivf(self) -> None:
+        n_lists = max(1, int(np.sqrt(self._count)))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(self._count, min(self._count, self.kmeans_sample), replace=False))
+        sample = np.asarray(self._matrix[sample_rows])
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(self.kmeans_iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            filled = counts > 0
+            centroids[filled] = self._normalize(sums[filled])
+        self._centroids = centroids
+        self._assignments = np.full(self._matrix.shape[0], -1, dtype=np.int32)
+        self._lists = [[] for _ in range(n_lists)]
+        for start in range(0, self._count, self.scan_block):
+            rows = np.arange(start, min(start + self.scan_block, self._count))
+            self._assign(rows, np.asarray(self._matrix[rows]))
+        self._ivf_built_size = self._count
+        logger.info(f"Local vector store {self.path}: built {n_lists} IVF lists over {self._count} vectors")
+
+    def _assign(self, rows: np.ndarray, values: np.ndarray) -> None:
+        labels = np.argmax(values @ self._centroids.T, axis=1)
+        for row, label in zip(rows.tolist(), labels.tolist()):
+            previous = self._assignments[row]
+            if previous == label:
+                continue
+            if previous >= 0:
+                self._lists[previous].remove(row)
+                self._list_arrays.pop(previous, None)
+            self._lists[label].append(row)
+            self._list_arrays.pop(label, None)
+            self._assignments[row] = label
+
+    def _probe(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """Rows of the partitions closest to ``query``, or None to scan everything."""
+        if self._centroids is None:
+            return None
+        nearest = self._top(self._centroids @ query, self.nprobe)
+        arrays = []
+        for label in nearest.tolist():
+            if label not in self._list_arrays:
+                self._list_arrays[label] = np.asarray(self._lists[label], dtype=np.int64)
+            arrays.append(self._list_arrays[label])
+        return np.sort(np.concatenate(arrays))
+
+    def _scan(self, query: np.ndarray, rows: Optional[np.ndarray], quantized: bool) -> np.ndarray:
+        source = self._quantized if quantized else self._matrix
+        total = self._count if rows is None else len(rows)
+        scores = np.empty(total, dtype=np.float32)
+        for start in range(0, total, self.scan_block):
+            end = min(start + self.scan_block, total)
+            block_rows = slice(start, end) if rows is None else rows[start:end]
+            block = source[block_rows]
+            if quantized:
+                scores[start:end] = (block.astype(np.float32) @ query) * self._scales[block_rows]
+            else:
+                scores[start:end] = block @ query
+        return scores
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top])]
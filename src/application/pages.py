@@ -0,0 +1,384 @@
+"""OCR of uploaded documents, including multi-page PDFs and TIFFs.
+
+Pages are split off on the preprocessing pool, stored in S3 next to the
+original and recognised concurrently, at most ``OCR_PAGE_CONCURRENCY`` per
+document. The document stream stays in page order: a page is written once it
+has been recognised and every page before it is done, and a page that fails
+half way leaves no text behind. Each page result is kept in ``doc_pages`` so
+a failed page can be retried on its own with ``retry_failed_pages``. Large single scans can be
+recognised the same way in overlapping strips, see ``ocr_tiles``.
+"""
+import asyncio
+import base64
+from difflib import SequenceMatcher
+from typing import Callable, Collection, Optional, Protocol, Sequence
+
+from loguru import logger
+
+from .chatgpt import ocr, generate_title, StreamSink
+from .s3 import upload_file_to_s3, download_file_from_s3, get_download_link_from_s3
+from .streaming import DocStreamWriter, reset_stream
+from .upscale import image_preprocessor, Tile, MULTI_PAGE_EXTENSIONS
+from src.infrastructure.database import get_uow
+from config import settings
+
+
+PAGE_SEPARATOR = "\n\n"
+
+
+class TextWriter(Protocol):
+    async def write(self, text: str) -> None: ...
+
+
+def page_object_name(doc_origin_id: str, page_number: int) -> str:
+    return f"{doc_origin_id}/pages/{page_number}.jpg"
+
+
+class OrderedPageStream:
+    """Writes the text of concurrently recognised pages in page order.
+
+    With ``dedup`` the pages in ``overlapping`` are held back until they are
+    finished and written as ``dedup(text written so far, page text)``; tiles
+    use this to drop the lines repeated in their overlap. Other pages stream
+    as they are, unless ``live`` is off: then every page is held back until it
+    is finished, so the text of a failed page can be dropped.
+    """
+
+    def __init__(
+        self,
+        writer: Optional[TextWriter],
+        page_count: int,
+        separator: str = PAGE_SEPARATOR,
+        dedup: Optional[Callable[[str, str], str]] = None,
+        overlapping: Collection[int] = (),
+        live: bool = True,
+    ) -> None:
+        self.writer = writer
+        self.separator = separator
+        self.dedup = dedup
+        self.overlapping = overlapping
+        self.live = live
+        self.current = 0
+        self._buffers: list[list[str]] = [[] for _ in range(page_count)]
+        self._finished = [False] * page_count
+        self._parts: list[str] = []
+        self._lock = asyncio.Lock()
+
+    @property
+    def text(self) -> str:
+        """Everything written so far."""
+        return "".join(self._parts)
+
+    def sink(self, page_number: int) -> StreamSink:
+        return _PageSink(self, page_number)
+
+    async def write(self, page_number: int, text: str) -> None:
+        async with self._lock:
+            if page_number == self.current and not self._held(page_number):
+                await self._write(text)
+            else:
+                self._buffers[page_number].append(text)
+
+    async def finish(self, page_number: int, failed: bool = False) -> None:
+        """Mark a page as done and release the pages waiting for it.
+
+        The held back text of a failed page is dropped.
+        """
+        async with self._lock:
+            if failed:
+                self._buffers[page_number] = []
+            self._finished[page_number] = True
+            while self.current < len(self._finished) and self._finished[self.current]:
+                await self._release(self.current)
+                self.current += 1
+                if self.current < len(self._finished):
+                    await self._write(self.separator)
+                    if not self._held(self.current):
+                        await self._release(self.current)
+
+    def _held(self, page_number: int) -> bool:
+        return not self.live or self._overlaps(page_number)
+
+    def _overlaps(self, page_number: int) -> bool:
+        return self.dedup is not None and page_number in self.overlapping
+
+    async def _release(self, page_number: int) -> None:
+        text = "".join(self._buffers[page_number])
+        self._buffers[page_number] = []
+        if self._overlaps(page_number):
+            text = self.dedup(self.text, text)
+        await self._write(text)
+
+    async def _write(self, text: str) -> None:
+        if not text:
+            return
+        self._parts.append(text)
+        if self.writer is not None:
+            await self.writer.write(text)
+
+
+class _SinkWriter:
+    """Feeds the ordered text to a document stream and to the caller's sinks."""
+
+    def __init__(self, writer: Optional[DocStreamWriter], sinks: Sequence[StreamSink]) -> None:
+        self.writer = writer
+        self.sinks = sinks
+
+    async def write(self, text: str) -> None:
+        if self.writer is not None:
+            await self.writer.write(text)
+        for sink in self.sinks:
+            await sink.on_delta(text)
+
+
+class _PageSink(StreamSink):
+    def __init__(self, stream: OrderedPageStream, page_number: int) -> None:
+        self.stream = stream
+        self.page_number = page_number
+
+    async def on_delta(self, text: str) -> None:
+        await self.stream.write(self.page_number, text)
+
+
+def _normalize_line(line: str) -> str:
+    return " ".join(line.strip(" #*>-|").lower().split())
+
+
+def _lines_match(a: str, b: str, min_ratio: float) -> bool:
+    # Ledger rows often differ only in a date or an amount
+    if [c for c in a if c.isdigit()] != [c for c in b if c.isdigit()]:
+        return False
+    return SequenceMatcher(None, a, b).ratio() >= min_ratio
+
+
+def merge_overlap(previous: str, text: str, max_lines: int = 12, min_ratio: float = 0.8) -> str:
+    """Drop the leading lines of ``text`` that repeat the last lines of ``previous``.
+
+    A strip cut through a line overlaps the strip below it, so both recognise
+    the lines in the overlap, often with small differences; lines are
+    compared fuzzily, except for their digits. Lines with nothing left after
+    normalising (table rules, blank lines) are skipped, they would match
+    anything.
+    """
+    tail = [line for line in map(_normalize_line, previous.splitlines()) if line][-max_lines:]
+    lines = text.splitlines()
+    head = [(i, line) for i, line in enumerate(map(_normalize_line, lines)) if line][:max_lines]
+    for count in range(min(len(tail), len(head)), 0, -1):
+        if all(_lines_match(a, b, min_ratio) for a, (_, b) in zip(tail[-count:], head[:count])):
+            return "\n".join(lines[head[count - 1][0] + 1:]).lstrip("\n")
+    return text
+
+
+async def ocr_tiles(
+    tiles: list[Tile],
+    doc_version_id: str | None = None,
+    key: str | None = None,
+    sinks: Sequence[StreamSink] = (),
+) -> str:
+    """OCR the tiles of one scan concurrently and merge their text in reading order.
+
+    Lines repeated in an overlap are dropped only where a tile overlaps the
+    one before it; a retry recognises every tile again and starts the
+    document stream over.
+    """
+    writer = None
+    if doc_version_id:
+        await reset_stream(doc_version_id)
+        writer = DocStreamWriter(doc_version_id)
+    stream = OrderedPageStream(
+        _SinkWriter(writer, sinks),
+        len(tiles),
+        separator="\n",
+        dedup=merge_overlap,
+        overlapping={n for n, tile in enumerate(tiles) if tile.overlaps_previous},
+    )
+    slots = asyncio.Semaphore(settings.OCR_TILE_CONCURRENCY)
+
+    async def run(tile_number: int, tile: Tile) -> None:
+        try:
+            async with slots:
+                url = f"data:image/jpeg;base64,{base64.b64encode(tile.content).decode()}"
+                await ocr(url, key=f"{key} tile {tile_number + 1}/{len(tiles)}", sinks=[stream.sink(tile_number)])
+        finally:
+            await stream.finish(tile_number)
+
+    results = await asyncio.gather(*(run(n, tile) for n, tile in enumerate(tiles)), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            if writer is not None:
+                writer.discard()
+            raise result
+    if writer is not None:
+        await writer.close()
+    return stream.text
+
+
+async def ocr_image(
+    data: bytes,
+    bucket_name: str,
+    object_name: str,
+    doc_version_id: str | None = None,
+    key: str | None = None,
+    sinks: Sequence[StreamSink] = (),
+) -> str:
+    """OCR an image stored at ``object_name``, sending the preprocessed version if there is one.
+
+    Large scans are recognised in tiles when ``OCR_TILING_ENABLED`` is set.
+    """
+    if settings.OCR_TILING_ENABLED:
+        tiles = await image_preprocessor.split_tiles(data, key or object_name)
+        if len(tiles) > 1:
+            return await ocr_tiles(tiles, doc_version_id, key or object_name, sinks)
+    url = None
+    if settings.IMAGE_PREPROCESS_ENABLED:
+        image = await image_preprocessor.process(data, key or object_name)
+        if image is not None:
+            url = f"data:{image.media_type};base64,{base64.b64encode(image.content).decode()}"
+    if url is None:
+        url = await get_download_link_from_s3(bucket_name, object_name)
+    return await ocr(url, doc_version_id, key or object_name, sinks)
+
+
+async def ocr_pages(
+    pages: list[bytes],
+    bucket_name: str,
+    doc_origin_id: str,
+    doc_version_id: str | None = None,
+    key: str | None = None,
+) -> str:
+    """OCR the pages concurrently and return their text joined in page order.
+
+    Pages recognised by an earlier attempt are taken from ``doc_pages``; the
+    document stream starts over and replays them.
+    """
+    uow = await get_uow()
+    async with uow:
+        await uow.chat_repo.create_doc_pages(doc_origin_id, len(pages))
+        done = {
+            page.page_number: page.content
+            for page in await uow.chat_repo.get_doc_pages(doc_origin_id)
+            if page.content is not None
+        }
+    if done:
+        logger.info(f"Doc {doc_origin_id}: {len(done)} of {len(pages)} pages recognised earlier")
+    writer = None
+    if doc_version_id:
+        await reset_stream(doc_version_id)
+        writer = DocStreamWriter(doc_version_id)
+    stream = OrderedPageStream(writer, len(pages), live=False)
+    slots = asyncio.Semaphore(settings.OCR_PAGE_CONCURRENCY)
+
+    async def run(page_number: int, data: bytes) -> bool:
+        if page_number in done:
+            await stream.write(page_number, done[page_number])
+            await stream.finish(page_number)
+            return True
+        object_name = page_object_name(doc_origin_id, page_number)
+        page_key = f"{key or doc_origin_id} p{page_number + 1}/{len(pages)}"
+        content, error = None, None
+        try:
+            # Kept for retries of this page
+            if not await upload_file_to_s3(data, bucket_name, object_name):
+                raise RuntimeError("S3 upload failed")
+            async with slots:
+                content = await ocr_image(
+                    data, bucket_name, object_name, key=page_key, sinks=[stream.sink(page_number)]
+                )
+        except Exception as e:
+            logger.error(f"OCR of {page_key} failed: {e!r}")
+            error = repr(e)
+        finally:
+            await stream.finish(page_number, failed=content is None)
+        uow = await get_uow()
+        async with uow:
+            await uow.chat_repo.set_doc_page_result(doc_origin_id, page_number, content, error)
+        return error is None
+
+    try:
+        results = await asyncio.gather(*(run(n, data) for n, data in enumerate(pages)))
+        logger.info(f"Doc {doc_origin_id}: {sum(results)} of {len(pages)} pages recognised")
+        if not any(results):
+            raise RuntimeError(f"No page of doc {doc_origin_id} could be recognised")
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is not None:
+        await writer.close()
+    return stream.text
+
+
+async def ocr_document(
+    bucket_name: str,
+    object_name: str,
+    doc_origin_id: str,
+    doc_version_id: str | None = None,
+    key: str | None = None,
+) -> str:
+    """OCR the uploaded file ``object_name``, page by page if it is a PDF or TIFF."""
+    ext = object_name.rsplit('.', 1)[-1].lower()
+    if ext in MULTI_PAGE_EXTENSIONS:
+        data = await download_file_from_s3(bucket_name, object_name)
+        pages = await image_preprocessor.split_pages(data, ext, key or object_name)
+        del data
+        return await ocr_pages(pages, bucket_name, doc_origin_id, doc_version_id, key)
+    if settings.IMAGE_PREPROCESS_ENABLED or settings.OCR_TILING_ENABLED:
+        # Tiling and preprocessing need the image itself, not a presigned URL
+        data = await download_file_from_s3(bucket_name, object_name)
+        return await ocr_image(data, bucket_name, object_name, doc_version_id, key)
+    url = await get_download_link_from_s3(bucket_name, object_name)
+    return await ocr(url, doc_version_id, key or object_name)
+
+
+async def ocr_uploaded_doc(bucket_name: str, object_name: str, doc_origin_id: str, doc_version_id: str) -> None:
+    text = await ocr_document(bucket_name, object_name, doc_origin_id, doc_version_id)
+    logger.info(text)
+    uow = await get_uow()
+    async with uow:
+        doc_version = await uow.chat_repo.edit_doc_version(doc_version_id, text)
+        await uow.chat_repo.edit_doc_origin(doc_version.doc_origin_id, text)
+        title = await generate_title(text)
+        logger.info(f"Title generated: {title}")
+        chat = doc_version.chat
+        chat.title = title
+        await uow.commit()
+
+
+async def retry_failed_pages(bucket_name: str, doc_version_id: str) -> Optional[str]:
+    """Re-run OCR of the failed pages of a document and store the re-stitched text.
+
+    Returns the new text, or None if no page had failed.
+    """
+    uow = await get_uow()
+    async with uow:
+        doc_version = await uow.chat_repo.get_doc_version_by_id(doc_version_id)
+        doc_origin_id = str(doc_version.doc_origin_id)
+        pages = await uow.chat_repo.get_doc_pages(doc_origin_id)
+    contents = {page.page_number: page.content for page in pages}
+    failed = [page_number for page_number, content in contents.items() if content is None]
+    if not failed:
+        return None
+    slots = asyncio.Semaphore(settings.OCR_PAGE_CONCURRENCY)
+
+    async def run(page_number: int) -> None:
+        object_name = page_object_name(doc_origin_id, page_number)
+        error = None
+        try:
+            async with slots:
+                data = await download_file_from_s3(bucket_name, object_name)
+                contents[page_number] = await ocr_image(data, bucket_name, object_name)
+        except Exception as e:
+            logger.error(f"Retry of {object_name} failed: {e!r}")
+            error = repr(e)
+        uow = await get_uow()
+        async with uow:
+            await uow.chat_repo.set_doc_page_result(doc_origin_id, page_number, contents[page_number], error)
+
+    await asyncio.gather(*(run(page_number) for page_number in failed))
+    text = PAGE_SEPARATOR.join(contents[page_number] or "" for page_number in sorted(contents))
+    uow = await get_uow()
+    async with uow:
+        await uow.chat_repo.edit_doc_version(doc_version_id, text)
+        await uow.chat_repo.edit_doc_origin(doc_origin_id, text)
+    logger.info(f"Doc {doc_origin_id}: {sum(contents[n] is not None for n in failed)} of {len(failed)} failed pages recovered")
+    return text
@@ -0,0 +1,138 @@
+"""OpenAI rate limiting shared by every web and job worker process.
+
+Each model has two token buckets in the Redis hash ``ratelimit:{model}``,
+one for requests and one for tokens per minute, refilled continuously and
+checked together in one Lua script. A call reserves one request and its
+estimated tokens up front; ``settle`` corrects the token bucket once the
+real usage is known.
+
+Callers that have to wait leave a marker in ``ratelimit:{model}:waiting:{priority}``
+(expiring after ``OPENAI_LIMIT_WAITER_TTL``). While a higher priority class
+is waiting, lower classes are not let through at all, so freed capacity goes
+to interactive answers first and bulk OCR only gets what is left.
+"""
+import asyncio
+import random
+import time
+import uuid
+from enum import IntEnum
+from typing import Any
+
+from loguru import logger
+
+from src.application.redis import RedisClient, redis_client
+from config import settings
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    REWRITE = 1
+    BULK = 2
+
+
+# KEYS: bucket hash, own waiting zset, waiting zsets of the higher priorities
+# ARGV: now, rpm, tpm, tokens, waiter id, waiter ttl
+# Returns the seconds to wait as a string, "0" once the call is let through
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rpm, tpm, cost = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local waiter, waiter_ttl = ARGV[5], tonumber(ARGV[6])
+for i = 3, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    if redis.call('ZCARD', KEYS[i]) > 0 then
+        redis.call('ZADD', KEYS[2], now + waiter_ttl, waiter)
+        return '-1'
+    end
+end
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts')
+local requests, tokens = rpm, tpm
+if state[3] then
+    local elapsed = math.max(now - tonumber(state[3]), 0)
+    requests = math.min(rpm, tonumber(state[1]) + elapsed * rpm / 60)
+    tokens = math.min(tpm, tonumber(state[2]) + elapsed * tpm / 60)
+end
+local wait = 0
+if requests < 1 then
+    wait = (1 - requests) * 60 / rpm
+end
+local need = math.min(cost, tpm)
+if tokens < need then
+    wait = math.max(wait, (need - tokens) * 60 / tpm)
+end
+if wait > 0 then
+    redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'ts', now)
+    redis.call('ZADD', KEYS[2], now + waiter_ttl, waiter)
+    return tostring(wait)
+end
+redis.call('HSET', KEYS[1], 'requests', requests - 1, 'tokens', tokens - cost, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('ZREM', KEYS[2], waiter)
+return '0'
+"""
+
+
+def estimate_tokens(messages: list[dict[str, Any]], max_tokens: int | None = None) -> int:
+    """Rough token count of a request: its text, its images and the expected answer."""
+    chars, images = 0, 0
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text", ""))
+    # Cyrillic text takes about a token per 3 characters
+    return (
+        chars // 3
+        + images * settings.OPENAI_EST_IMAGE_TOKENS
+        + (max_tokens or settings.OPENAI_EST_COMPLETION_TOKENS)
+    )
+
+
+class RateLimiter:
+    def __init__(self, redis: RedisClient, limits: dict[str, tuple[int, int]]) -> None:
+        self._redis = redis
+        self._limits = limits
+        self._script = None
+
+    async def acquire(self, model: str, tokens: int, priority: Priority) -> None:
+        """Wait until ``model`` has room for one request of ``tokens`` tokens."""
+        if model not in self._limits:
+            return
+        if self._script is None:
+            self._script = self._redis.register_script(ACQUIRE_SCRIPT)
+        rpm, tpm = self._limits[model]
+        bucket = f"ratelimit:{model}"
+        keys = [bucket] + [f"{bucket}:waiting:{p}" for p in range(priority, -1, -1)]
+        waiter = uuid.uuid4().hex
+        started = time.perf_counter()
+        while True:
+            wait = float(await self._script(
+                keys=keys,
+                args=[time.time(), rpm, tpm, tokens, waiter, settings.OPENAI_LIMIT_WAITER_TTL],
+            ))
+            if wait == 0:
+                break
+            if wait < 0:
+                # A higher priority is waiting: poll often so our marker stays fresh
+                wait = 0.05
+            # Re-check at least every second to keep the waiting marker alive
+            await asyncio.sleep(min(wait, 1.0) * random.uniform(1.0, 1.2))
+        waited = time.perf_counter() - started
+        if waited > 0.1:
+            logger.info(f"{priority.name} call to {model} waited {waited:.2f}s for rate limit ({tokens} tokens)")
+
+    async def settle(self, model: str, reserved: int, used: int) -> None:
+        """Return the tokens reserved but not used, or take the ones used beyond the reservation."""
+        if model not in self._limits or used == reserved:
+            return
+        bucket = f"ratelimit:{model}"
+        # An expired bucket starts full again, there is nothing to correct
+        if await self._redis.exists(bucket):
+            await self._redis.redis.hincrbyfloat(bucket, "tokens", reserved - used)
+
+
+openai_limiter = RateLimiter(redis_client, settings.OPENAI_RATE_LIMITS)
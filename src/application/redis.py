@@ -36,6 +36,26 @@ class RedisClient:
         if expire_at:
             await self.redis.expireat(key, expire_at)
 
+    async def mget(self, *keys: str) -> list[Any]:
+        values = await self.redis.mget(keys)
+        return [json.loads(value) if value else None for value in values]
+
+    async def set_many(self, mapping: dict[str, Any], expire: int) -> None:
+        """``SET EX`` every item in one pipelined round trip."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, json.dumps(value), ex=expire)
+            await pipe.execute()
+
+    async def get_raw(self, key: str) -> bytes | None:
+        return await self.redis.get(key)
+
+    async def set_raw(self, key: str, value: bytes, expire: int | None = None) -> None:
+        await self.redis.set(key, value, ex=expire)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self.redis.incr(key, amount)
+
     async def incr_and_expireat(self, key: str, amount: int = 1, expire: datetime = None):
         count = await self.redis.incr(key, amount)
         await self.redis.expireat(key, expire)
@@ -46,6 +66,18 @@ class RedisClient:
         await self.redis.expire(key, time=expire)
         return count
 
+    async def hget(self, name: str, key: str) -> Any:
+        value = await self.redis.hget(name, key)
+        if value is not None:
+            return json.loads(value)
+        return None
+
+    async def hset(self, name: str, key: str, value: Any) -> None:
+        await self.redis.hset(name, key, json.dumps(value))
+
+    async def hdel(self, name: str, *keys: str) -> int:
+        return await self.redis.hdel(name, *keys)
+
     async def sismember(self, name: str, value: Any) -> bool:
         value_str = json.dumps(value)
         return await self.redis.sismember(name, value_str)
@@ -55,9 +87,38 @@ class RedisClient:
     
     async def srem(self, name: str, *values: list[Any]) -> int:
         return await self.redis.srem(name, *(json.dumps(v) for v in values))
+
+    async def smembers(self, name: str) -> list[Any]:
+        return [json.loads(v) for v in await self.redis.smembers(name)]
     
-    async def rpush(self, name: str, *values: list[Any]) -> None:
-        await self.redis.rpush(name, *(json.dumps(v) for v in values))
+    async def rpush(self, name: str, *values: list[Any]) -> int:
+        return await self.redis.rpush(name, *(json.dumps(v) for v in values))
+
+    async def lrange(self, name: str, start: int = 0, end: int = -1) -> list[Any]:
+        response = await self.redis.lrange(name, start, end)
+        return [json.loads(i) for i in response]
+
+    async def xrange(self, name: str, min: str = "-", max: str = "+") -> list[tuple[str, dict[str, Any]]]:
+        response = await self.redis.xrange(name, min, max)
+        return [
+            (entry_id.decode(), {k.decode(): json.loads(v) for k, v in fields.items()})
+            for entry_id, fields in response
+        ]
+
+    async def exists(self, key: str) -> bool:
+        return bool(await self.redis.exists(key))
+
+    async def publish(self, channel: str, value: Any) -> int:
+        return await self.redis.publish(channel, json.dumps(value))
+
+    def pubsub(self):
+        return self.redis.pubsub()
+
+    def pipeline(self, transaction: bool = False):
+        return self.redis.pipeline(transaction=transaction)
+
+    def register_script(self, script: str):
+        return self.redis.register_script(script)
         
     async def lpop(self, name: str, count: int | None = None) -> Any:
         response = await self.redis.lpop(name, count)
@@ -1,14 +1,13 @@
+from contextlib import AsyncExitStack
+from typing import Awaitable, Callable, Sequence
+
 import aioboto3
+from aiobotocore.config import AioConfig
 from loguru import logger
-from aiofiles import open as aopen
 from starlette.concurrency import run_in_threadpool
 
-from .chatgpt import ocr, generate_title
 from .redis import redis_client
-# from src.application.upscale import preprocess_image
-from src.application.vectordb import text_to_vector, Doc
 from src.infrastructure.uow import SQLAlchemyUoW
-from src.presentation.di import get_uow
 from config import settings
 
 
@@ -19,49 +18,113 @@ session = aioboto3.Session(
 )
 
 
-async def upload_s3_and_ocr(
-    file_content: bytes,
+class S3Client:
+    """The worker's S3 client, opened once by ``lifespan_s3``.
+
+    Building a client resolves credentials and endpoints and creates a new
+    connection pool, so every request shares this one instead.
+    """
+
+    def __init__(self, session: aioboto3.Session, config: AioConfig) -> None:
+        self.session = session
+        self.config = config
+        self.client = None
+        self._exit_stack = AsyncExitStack()
+
+    async def connect(self) -> None:
+        self.client = await self._exit_stack.enter_async_context(
+            self.session.client('s3', config=self.config)
+        )
+
+    async def close(self) -> None:
+        await self._exit_stack.aclose()
+        self.client = None
+
+
+s3_client = S3Client(
+    session,
+    AioConfig(
+        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+        connector_args={'keepalive_timeout': settings.S3_KEEPALIVE_TIMEOUT},
+    ),
+)
+
+
+async def upload_stream_to_s3(
+    read: Callable[[int], Awaitable[bytes]],
     bucket_name: str,
     object_name: str,
-    doc_version_id: str
-) -> None:
-    await upload_file_to_s3(file_content, bucket_name, object_name)
-    url = await get_download_link_from_s3(bucket_name, object_name)
-    logger.info(f"Url: {url}")
-    text = await ocr(url, doc_version_id)
-    logger.info(text)
-    uow = await get_uow()
-    async with uow:
-        doc_version = await uow.chat_repo.edit_doc_version(doc_version_id, text)
-        await uow.chat_repo.edit_doc_origin(doc_version.doc_origin_id, text)
-        title = await generate_title(text)
-        logger.info(f"Title generated: {title}")
-        chat = doc_version.chat
-        chat.title = title
-        await uow.commit()
-    await run_in_threadpool(text_to_vector, Doc(text, doc_version_id))
+    part_size: int = settings.S3_MULTIPART_PART_SIZE,
+) -> bool:
+    """Upload the stream returned by ``read(size)`` without holding it in memory.
 
+    At most two parts of ``part_size`` bytes are buffered at a time, the one
+    being uploaded and the one read ahead of it. A stream that fits in one
+    part is stored with a single ``PutObject``, a longer one with a multipart
+    upload that is aborted if any part fails.
+    """
+    client = s3_client.client
+    try:
+        chunk = await read(part_size)
+        next_chunk = await read(part_size)
+        if not next_chunk:
+            await client.put_object(Bucket=bucket_name, Key=object_name, Body=chunk)
+            logger.info(f"Uploaded {bucket_name}/{object_name} ({len(chunk)} bytes)")
+            return True
+        upload = await client.create_multipart_upload(Bucket=bucket_name, Key=object_name)
+        upload_id = upload['UploadId']
+        parts = []
+        size = 0
+        try:
+            while chunk:
+                part = await client.upload_part(
+                    Bucket=bucket_name,
+                    Key=object_name,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=chunk,
+                )
+                parts.append({'PartNumber': len(parts) + 1, 'ETag': part['ETag']})
+                size += len(chunk)
+                chunk = next_chunk or await read(part_size)
+                next_chunk = b""
+            await client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=object_name,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            await client.abort_multipart_upload(Bucket=bucket_name, Key=object_name, UploadId=upload_id)
+            raise
+        logger.info(f"Uploaded {bucket_name}/{object_name} ({size} bytes, {len(parts)} parts)")
+    except Exception as e:
+        logger.error(f"Error uploading {bucket_name}/{object_name}: {e}")
+        return False
+    return True
 
-async def upload_file_to_s3(file_content: bytes, bucket_name: str, object_name: str):
-    file_path = f'temp_files/{object_name}'
-    # await run_in_threadpool(preprocess_image, file_path, file_path)
-    async with aopen(file_path, 'wb') as f:
-        await f.write(file_content)
 
-    async with session.client('s3') as s3_client:
-        try:
-            async with aopen(file_path, 'rb') as file:
-                await s3_client.upload_fileobj(file, bucket_name, object_name)
-            logger.info(f"File {file_path} uploaded to {bucket_name}/{object_name}")
-        except Exception as e:
-            logger.info(f"Error uploading file: {e}")
-            return False
+async def upload_file_to_s3(file_content: bytes, bucket_name: str, object_name: str):
+    try:
+        await s3_client.client.put_object(Bucket=bucket_name, Key=object_name, Body=file_content)
+        logger.info(f"File uploaded to {bucket_name}/{object_name}")
+    except Exception as e:
+        logger.info(f"Error uploading file: {e}")
+        return False
     return True
 
 
+async def download_file_from_s3(bucket_name: str, object_name: str) -> bytes:
+    response = await s3_client.client.get_object(Bucket=bucket_name, Key=object_name)
+    async with response['Body'] as body:
+        return await body.read()
+
+
 async def get_download_link_from_s3(bucket_name: str, object_name: str, expiration: int = 3600):
     """Получить временную ссылку для скачивания файла из S3.
 
+    Подпись считается локально общим клиентом, без запросов к S3.
+
     Args:
         bucket_name (str): Название S3-бакета.
         object_name (str): Имя объекта в бакете.
@@ -70,25 +133,49 @@ async def get_download_link_from_s3(bucket_name: str, object_name: str, expirati
     Returns:
         str: Временная ссылка для скачивания файла.
     """
-    async with session.client('s3') as s3_client:
-        try:
-            download_url = await s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': bucket_name, 'Key': object_name},
-                ExpiresIn=expiration
-            )
-            logger.info(f"Generated download link for {bucket_name}/{object_name}: {download_url}")
-            return download_url
-        except Exception as e:
-            logger.error(f"Error generating download link: {e}")
-            return None
-
-
-async def get_download_link_from_s3_cached(bucket_name: str, object_name: str, expire: int = 3600) -> str:
-    url = await redis_client.get(f"download_url:{bucket_name}:{object_name}")
-    logger.info(f"url1: {url!r}")
-    if not url:
-        url = str(await get_download_link_from_s3(bucket_name, object_name, expire))
-        logger.info(f"url2: {url!r}")
-        await redis_client.set(f"download_url:{bucket_name}:{object_name}", url, expire)
-    return url
+    try:
+        download_url = await s3_client.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': object_name},
+            ExpiresIn=expiration
+        )
+        logger.debug(f"Generated download link for {bucket_name}/{object_name}")
+        return download_url
+    except Exception as e:
+        logger.error(f"Error generating download link: {e}")
+        return None
+
+
+def download_url_cache_ttl(expire: int) -> int:
+    """Cached links expire this much before the signature does, so none is served stale."""
+    return max(expire - settings.S3_URL_CACHE_MARGIN, 1)
+
+
+async def get_download_links_from_s3_cached(
+    bucket_name: str, object_names: Sequence[str], expire: int = 3600
+) -> dict[str, str | None]:
+    """Download links for all ``object_names``: one ``MGET``, local signing of the misses, one pipelined write."""
+    object_names = list(dict.fromkeys(object_names))
+    if not object_names:
+        return {}
+    keys = [f"download_url:{bucket_name}:{object_name}" for object_name in object_names]
+    urls = dict(zip(object_names, await redis_client.mget(*keys)))
+    misses = {
+        key: object_name
+        for key, object_name in zip(keys, object_names)
+        if not urls[object_name]
+    }
+    signed = {}
+    for key, object_name in misses.items():
+        urls[object_name] = await get_download_link_from_s3(bucket_name, object_name, expire)
+        if urls[object_name]:
+            signed[key] = urls[object_name]
+    if signed:
+        await redis_client.set_many(signed, download_url_cache_ttl(expire))
+    logger.debug(f"Download links: {len(object_names) - len(misses)} cached, {len(misses)} signed")
+    return urls
+
+
+async def get_download_link_from_s3_cached(bucket_name: str, object_name: str, expire: int = 3600) -> str | None:
+    urls = await get_download_links_from_s3_cached(bucket_name, [object_name], expire)
+    return urls[object_name]
@@ -0,0 +1,337 @@
+"""Resumable document text streams and their fan-out to WebSockets.
+
+Producers (OCR, rewrite) append chunks to the Redis Stream ``stream:{id}``
+and publish them on ``stream_events:{id}``. Entry ids encode the character
+offset at which a chunk ends (``{end}-0``; the close marker is ``{end}-1``),
+so any reader can resume from a character offset with one ``XRANGE`` and any
+number of readers can share a stream. Finished streams expire after
+``STREAM_FINISHED_TTL`` and are served from Postgres afterwards. The text
+of an unfinished stream is also the checkpoint a retried producer resumes
+from, see ``stream_doc_completion``.
+
+Every uvicorn worker keeps a single pub/sub connection in ``StreamHub`` and
+hands chunks to local subscribers through asyncio queues, so an idle socket
+costs no Redis round trips at all.
+"""
+import asyncio
+import json
+from collections import defaultdict
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator
+
+from loguru import logger
+
+from src.application.redis import RedisClient, redis_client
+from config import settings
+
+
+CLOSE_MARKER = "[close]"
+
+
+def stream_key(doc_version_id: str) -> str:
+    return f"stream:{doc_version_id}"
+
+
+def channel_name(doc_version_id: str) -> str:
+    return f"stream_events:{doc_version_id}"
+
+
+class DocStreamWriter:
+    """Producer side of a document stream.
+
+    Tokens are buffered and flushed as one entry once ``flush_bytes`` have
+    accumulated or ``flush_interval`` seconds have passed since the first
+    buffered token. A flush is a single pipelined round trip.
+    """
+
+    def __init__(
+        self,
+        doc_version_id: str,
+        offset: int = 0,
+        flush_bytes: int = settings.STREAM_FLUSH_BYTES,
+        flush_interval: float = settings.STREAM_FLUSH_INTERVAL,
+    ) -> None:
+        self.doc_version_id = doc_version_id
+        self.offset = offset
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._buffer: list[str] = []
+        self._buffered_bytes = 0
+        self._timer: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    async def write(self, text: str) -> None:
+        if not text:
+            return
+        self._buffer.append(text)
+        self._buffered_bytes += len(text.encode())
+        if self._buffered_bytes >= self.flush_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        await self._flush(close=False)
+
+    def discard(self) -> None:
+        """Drop the unflushed text; used when the producer failed and will be retried."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._buffer.clear()
+        self._buffered_bytes = 0
+
+    async def close(self) -> None:
+        await self._flush(close=True)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        try:
+            await self._flush(close=False)
+        except Exception as e:
+            logger.error(f"Stream {self.doc_version_id} flush failed: {e}")
+
+    async def _flush(self, close: bool) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            text = "".join(self._buffer)
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            if not text and not close:
+                return
+            key = stream_key(self.doc_version_id)
+            pipe = redis_client.pipeline()
+            if text:
+                self.offset += len(text)
+                self._append(pipe, f"{self.offset}-0", text)
+            if close:
+                self._append(pipe, f"{self.offset}-1", CLOSE_MARKER)
+                pipe.expire(key, settings.STREAM_FINISHED_TTL)
+                pipe.srem("active_streams", json.dumps(self.doc_version_id))
+            else:
+                pipe.expire(key, settings.STREAM_TTL)
+            await pipe.execute()
+
+    def _append(self, pipe, entry_id: str, text: str) -> None:
+        key = stream_key(self.doc_version_id)
+        pipe.xadd(key, {"t": json.dumps(text)}, id=entry_id, maxlen=settings.STREAM_MAXLEN, approximate=True)
+        pipe.publish(channel_name(self.doc_version_id), json.dumps({"id": entry_id, "t": text}))
+
+
+class Subscription:
+    """Ordered view of one document stream for a single WebSocket.
+
+    The backlog after ``offset`` is read from Redis on the first ``read``;
+    after that Redis is touched again only if the local queue overflowed
+    (slow client), a gap shows up, the hub lost messages while reconnecting
+    or nothing arrived for a heartbeat interval.
+    """
+
+    def __init__(self, doc_version_id: str, queue_size: int, offset: int = 0) -> None:
+        self.doc_version_id = doc_version_id
+        self.offset = offset
+        self.closed = False
+        self._queue: asyncio.Queue[tuple[str, str] | None] = asyncio.Queue(queue_size)
+        self._lagging = False
+        self._need_sync = True
+
+    def put(self, entry_id: str, text: str) -> None:
+        if self._lagging:
+            return
+        try:
+            self._queue.put_nowait((entry_id, text))
+        except asyncio.QueueFull:
+            # Backpressure: drop what is buffered, the reader catches up from Redis
+            self._lag()
+
+    def resync(self) -> None:
+        """Make the reader catch up from Redis, published chunks may have been lost."""
+        if self._lagging:
+            return
+        try:
+            self._queue.put_nowait(None)
+        except asyncio.QueueFull:
+            self._lag()
+
+    def _lag(self) -> None:
+        self._lagging = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    async def read(self, timeout: float) -> str | None:
+        """Return the text that arrived since the previous read.
+
+        Waits up to ``timeout`` seconds for the first chunk and returns None if
+        nothing came, so the caller can send a heartbeat. A silent stream is
+        checked in Redis first: a lost close marker would keep the socket open
+        forever, and a stream that expired without one is treated as closed.
+        """
+        parts = []
+        if self._need_sync:
+            await self._sync(parts)
+        if not parts and not self.closed:
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except TimeoutError:
+                await self._sync(parts)
+                if not parts and not self.closed and not await stream_is_live(self.doc_version_id):
+                    self.closed = True
+                return "".join(parts) if parts or self.closed else None
+            await self._accept(item, parts)
+        while not self.closed and not self._queue.empty():
+            await self._accept(self._queue.get_nowait(), parts)
+        return "".join(parts)
+
+    async def _accept(self, item: tuple[str, str] | None, parts: list[str]) -> None:
+        if item is None:
+            self._lagging = False
+            self._need_sync = True
+        elif not self._apply(*item, parts):
+            self._need_sync = True
+        if self._need_sync and not self.closed:
+            await self._sync(parts)
+
+    async def _sync(self, parts: list[str]) -> None:
+        self._need_sync = False
+        entries = await redis_client.xrange(stream_key(self.doc_version_id), min=f"{self.offset}-1")
+        for entry_id, fields in entries:
+            if not self._apply(entry_id, fields["t"], parts):
+                # The start of the stream was trimmed by MAXLEN, skip the hole
+                end, seq = map(int, entry_id.split("-"))
+                self.offset = end if seq else end - len(fields["t"])
+                self._apply(entry_id, fields["t"], parts)
+
+    def _apply(self, entry_id: str, text: str, parts: list[str]) -> bool:
+        """Add an entry to ``parts``; return False if entries before it are missing."""
+        end, seq = map(int, entry_id.split("-"))
+        if seq == 1:
+            if end > self.offset:
+                return False
+            self.closed = True
+            return True
+        start = end - len(text)
+        if end <= self.offset:
+            return True
+        if start > self.offset:
+            return False
+        parts.append(text[self.offset - start:])
+        self.offset = end
+        return True
+
+
+class StreamHub:
+    """One pub/sub connection per worker shared by all local stream readers."""
+
+    def __init__(self, redis: RedisClient, queue_size: int = 256) -> None:
+        self._redis = redis
+        self._queue_size = queue_size
+        self._subscriptions: dict[str, set[Subscription]] = defaultdict(set)
+        # Channel SUBSCRIBE of every doc with local readers, shared by all of them
+        self._ready: dict[str, asyncio.Future] = {}
+        self._has_channels = asyncio.Event()
+        self._pubsub = None
+        self._reader: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._pubsub = self._redis.pubsub()
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def stop(self) -> None:
+        self._reader.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._reader
+        await self._pubsub.reset()
+
+    @asynccontextmanager
+    async def subscribe(self, doc_version_id: str, offset: int = 0) -> AsyncIterator[Subscription]:
+        subscription = Subscription(doc_version_id, self._queue_size, offset)
+        subscriptions = self._subscriptions[doc_version_id]
+        subscriptions.add(subscription)
+        ready = self._ready.get(doc_version_id)
+        if ready is None or ready.done() and ready.exception() is not None:
+            ready = self._ready[doc_version_id] = asyncio.ensure_future(self._subscribe(doc_version_id))
+        try:
+            # Every reader waits for the SUBSCRIBE, chunks published before it are lost
+            await asyncio.shield(ready)
+            yield subscription
+        finally:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(doc_version_id, None)
+                self._ready.pop(doc_version_id, None)
+                await self._pubsub.unsubscribe(channel_name(doc_version_id))
+
+    async def _subscribe(self, doc_version_id: str) -> None:
+        await self._pubsub.subscribe(channel_name(doc_version_id))
+        self._has_channels.set()
+
+    async def _read_loop(self) -> None:
+        reconnected = False
+        while True:
+            if not self._pubsub.subscribed:
+                self._has_channels.clear()
+                await self._has_channels.wait()
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Stream hub read failed: {e}")
+                reconnected = True
+                await asyncio.sleep(1)
+                continue
+            if reconnected:
+                # The connection is back and resubscribed, catch up on what was published meanwhile
+                reconnected = False
+                for subscriptions in tuple(self._subscriptions.values()):
+                    for subscription in tuple(subscriptions):
+                        subscription.resync()
+            if message is None:
+                continue
+            doc_version_id = message["channel"].decode().split(":", 1)[1]
+            payload = json.loads(message["data"])
+            for subscription in tuple(self._subscriptions.get(doc_version_id, ())):
+                subscription.put(payload["id"], payload["t"])
+
+
+async def read_stream_text(doc_version_id: str) -> tuple[str, bool] | None:
+    """Return the text of a stream and whether it was closed.
+
+    Returns None if the start of the stream was trimmed, so the text is incomplete.
+    """
+    parts, offset, closed = [], 0, False
+    for entry_id, fields in await redis_client.xrange(stream_key(doc_version_id)):
+        end, seq = map(int, entry_id.split("-"))
+        if seq == 1:
+            closed = True
+            continue
+        if end - len(fields["t"]) != offset:
+            return None
+        parts.append(fields["t"])
+        offset = end
+    return "".join(parts), closed
+
+
+async def reset_stream(doc_version_id: str) -> None:
+    """Drop the entries of a stream so its producer can start over."""
+    await redis_client.delete(stream_key(doc_version_id))
+
+
+async def abort_stream(doc_version_id: str) -> None:
+    """Close a stream whose producer gave up, so readers stop waiting for it."""
+    await reset_stream(doc_version_id)
+    await DocStreamWriter(doc_version_id).close()
+
+
+async def stream_is_live(doc_version_id: str) -> bool:
+    """Whether the stream can still be read from Redis rather than Postgres."""
+    if await redis_client.exists(stream_key(doc_version_id)):
+        return True
+    return await redis_client.sismember("active_streams", doc_version_id)
+
+
+stream_hub = StreamHub(redis_client, queue_size=settings.STREAM_QUEUE_SIZE)
@@ -0,0 +1,106 @@
+"""Keeps the vector index in step with ``doc_origins`` through the outbox.
+
+Every content change writes a ``vector_outbox`` row in the same transaction.
+``VectorSyncWorker`` drains the outbox in batches (``SKIP LOCKED``, so all
+uvicorn workers can run it) and re-embeds a document only when the sha256 of
+its content differs from the hash that was indexed last. Entries whose
+document fails to embed are retried with exponential backoff and, after
+``VECTOR_SYNC_MAX_ATTEMPTS`` claims, dead-lettered (``dead_at`` is set).
+"""
+import asyncio
+import hashlib
+from contextlib import suppress
+from typing import Optional
+
+from loguru import logger
+
+from src.application.vectordb import text_to_vector, Doc
+from src.infrastructure.database import get_uow
+from config import settings
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def retry_delay(attempts: int) -> float:
+    return min(settings.VECTOR_SYNC_BACKOFF * 2 ** (attempts - 1), settings.VECTOR_SYNC_BACKOFF_MAX)
+
+
+async def sync_vector_outbox(batch_size: int = settings.VECTOR_SYNC_BATCH_SIZE) -> int:
+    """Process one batch of due outbox entries; return the number of entries claimed."""
+    uow = await get_uow()
+    async with uow:
+        # The claim is committed, nothing stays locked while documents are embedded
+        entries = await uow.chat_repo.claim_vector_outbox(batch_size, settings.VECTOR_SYNC_LEASE)
+        if not entries:
+            return 0
+        doc_origins = await uow.chat_repo.get_doc_origins_by_ids(
+            list({str(entry.doc_origin_id) for entry in entries})
+        )
+    changed = {}
+    for doc_origin_id, doc_origin in doc_origins.items():
+        if not doc_origin.content:
+            continue
+        digest = content_hash(doc_origin.content)
+        if digest != doc_origin.indexed_content_hash:
+            changed[doc_origin_id] = (doc_origin.content, digest)
+
+    results = await asyncio.gather(*(
+        text_to_vector(Doc(content, doc_origin_id))
+        for doc_origin_id, (content, _) in changed.items()
+    ), return_exceptions=True)
+    errors = {}
+    uow = await get_uow()
+    async with uow:
+        for (doc_origin_id, (_, digest)), result in zip(changed.items(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Vector sync of doc {doc_origin_id} failed: {result!r}")
+                errors[doc_origin_id] = repr(result)
+            else:
+                await uow.chat_repo.set_indexed_content_hash(doc_origin_id, digest)
+        await uow.chat_repo.delete_vector_outbox([
+            entry.id for entry in entries if str(entry.doc_origin_id) not in errors
+        ])
+        dead = 0
+        for entry in entries:
+            error = errors.get(str(entry.doc_origin_id))
+            if error is None:
+                continue
+            if entry.attempts >= settings.VECTOR_SYNC_MAX_ATTEMPTS:
+                await uow.chat_repo.bury_vector_outbox([entry.id], error)
+                dead += 1
+            else:
+                await uow.chat_repo.retry_vector_outbox([entry.id], retry_delay(entry.attempts), error)
+        await uow.commit()
+    logger.info(
+        f"Vector sync: {len(entries)} outbox entries, "
+        f"{len(changed) - len(errors)} docs re-embedded, {len(errors)} failed, {dead} entries dead-lettered"
+    )
+    return len(entries)
+
+
+class VectorSyncWorker:
+    def __init__(self, interval: float = settings.VECTOR_SYNC_INTERVAL) -> None:
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                while await sync_vector_outbox():
+                    pass
+            except Exception as e:
+                logger.error(f"Vector sync failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+
+vector_sync_worker = VectorSyncWorker()
@@ -1,13 +1,23 @@
+import asyncio
+import hashlib
 import os
+import time
+from collections import OrderedDict
+from contextlib import suppress
+import numpy as np
 from pinecone import Pinecone, ServerlessSpec
 from dotenv import load_dotenv, find_dotenv
 from typing import List, Dict, Any, Optional
 from llama_index.embeddings.gemini import GeminiEmbedding
 from config import settings
 from dataclasses import dataclass
+from starlette.concurrency import run_in_threadpool
+from loguru import logger
 
+from src.application.redis import redis_client
 
-model_name = "models/embedding-001"
+
+model_name = settings.EMBED_MODEL_NAME
 
 embed_model = GeminiEmbedding(
     model_name=model_name, api_key=settings.GOOGLE_AI_API_KEY, title="this is a document"
@@ -20,13 +30,64 @@ class Doc:
     id: str
 
 
-def initialize_pinecone() -> Pinecone:
+@dataclass
+class Chunk:
+    """A piece of a document as stored in the vector index."""
+    doc_id: str
+    index: int
+    start: int
+    end: int
+    text: str
+
+    @property
+    def vector_id(self) -> str:
+        return f"{self.doc_id}#{self.index}"
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return {"doc_id": self.doc_id, "start": self.start, "end": self.end}
+
+
+def split_text(
+    text: str,
+    size: int = settings.EMBED_CHUNK_SIZE,
+    overlap: int = settings.EMBED_CHUNK_OVERLAP,
+) -> List[tuple[int, int]]:
+    """Split ``text`` into overlapping ``(start, end)`` spans of about ``size`` chars.
+
+    Spans end and start at whitespace where possible so words are not cut.
+    """
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind(" ", start + size // 2, end), text.rfind("\n", start + size // 2, end))
+            if cut > start:
+                end = cut
+        spans.append((start, end))
+        if end >= len(text):
+            break
+        next_start = max(end - overlap, start + 1)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return spans
+
+
+def chunk_doc(doc: Doc) -> List[Chunk]:
+    return [
+        Chunk(doc.id, i, start, end, doc.text[start:end])
+        for i, (start, end) in enumerate(split_text(doc.text))
+    ]
+
+
+def initialize_pinecone() -> Pinecone.Index:
     # load_dotenv(find_dotenv())  # read local .env file
     api_key = settings.PINECONE_API_KEY
     environment = settings.PINECONE_ENVIRONMENT
     index_name = 'archive-hackaton'
 
-    pc = Pinecone(api_key=api_key)
+    pc = Pinecone(api_key=api_key, pool_threads=settings.PINECONE_POOL_THREADS)
 
     if index_name not in pc.list_indexes().names():
         pc.create_index(
@@ -39,34 +100,371 @@ def initialize_pinecone() -> Pinecone:
             )
         )
 
-    return pc.Index(index_name)
+    return pc.Index(index_name, pool_threads=settings.PINECONE_POOL_THREADS)
+
+
+class VectorStore:
+    """Async interface of the similarity index used by vectorisation and search.
+
+    ``query`` answers in Pinecone's shape:
+    ``{"matches": [{"id": ..., "score": ..., "metadata": ...}]}``.
+    """
+
+    def connect(self) -> None:
+        pass
+
+    async def upsert(self, vectors: List[tuple]) -> None:
+        raise NotImplementedError
+
+    async def query(self, vector: List[float], top_k: int = 9, include_metadata: bool = True) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def delete(self, ids: List[str]) -> None:
+        raise NotImplementedError
+
+    async def delete_all(self) -> None:
+        raise NotImplementedError
+
+
+class PineconeStore(VectorStore):
+    """Process-wide Pinecone index handle with an async facade.
+
+    The handle (and its HTTP connection pool) is created once per worker in
+    the app lifespan; the blocking client calls run in the threadpool.
+    """
+
+    def __init__(self) -> None:
+        self._index: Optional[Pinecone.Index] = None
+
+    def connect(self) -> None:
+        if self._index is None:
+            self._index = initialize_pinecone()
+
+    async def get_index(self) -> Pinecone.Index:
+        if self._index is None:
+            await run_in_threadpool(self.connect)
+        return self._index
+
+    async def upsert(self, vectors: List[tuple]) -> None:
+        index = await self.get_index()
+        await run_in_threadpool(index.upsert, vectors=vectors)
+
+    async def query(self, vector: List[float], top_k: int = 9, include_metadata: bool = True) -> Dict[str, Any]:
+        index = await self.get_index()
+        return await run_in_threadpool(
+            index.query, vector=vector, top_k=top_k, include_metadata=include_metadata
+        )
+
+    async def delete(self, ids: List[str]) -> None:
+        index = await self.get_index()
+        await run_in_threadpool(index.delete, ids=ids)
+
+    async def delete_all(self) -> None:
+        index = await self.get_index()
+        await run_in_threadpool(index.delete, delete_all=True)
+
+
+def create_vector_store() -> VectorStore:
+    if settings.VECTOR_STORE == "local":
+        from src.application.local_vectordb import LocalVectorStore
+
+        return LocalVectorStore(
+            settings.LOCAL_VECTOR_STORE_PATH,
+            dimension=768,
+            quantize=settings.LOCAL_VECTOR_STORE_QUANTIZE,
+            ivf_min_size=settings.LOCAL_VECTOR_STORE_IVF_MIN_SIZE,
+            nprobe=settings.LOCAL_VECTOR_STORE_NPROBE,
+        )
+    return PineconeStore()
+
+
+vector_index = create_vector_store()
+
+
+@dataclass
+class _PendingChunk:
+    chunk: Chunk
+    future: asyncio.Future
+    attempts: int = 0
+    vector: Optional[List[float]] = None
+
+
+class EmbeddingBatcher:
+    """Collects document chunks for a short window and vectorises them in bulk.
 
+    One batch embedding call per ``batch_size`` chunks and one index upsert
+    per ``upsert_batch_size`` vectors. Items of a failed call are
+    queued again with exponential backoff, up to ``max_retries`` times.
+    """
 
-def text_to_vector(doc: Doc, index: Optional[Pinecone.Index] = None) -> List[float]:
-    if index is None:
-        index = initialize_pinecone()
-    # Generate the vector for the document text
-    vector = embed_model.get_text_embedding(doc.text)
+    def __init__(
+        self,
+        window: float = settings.EMBED_BATCH_WINDOW,
+        batch_size: int = settings.EMBED_BATCH_SIZE,
+        upsert_batch_size: int = settings.PINECONE_UPSERT_BATCH_SIZE,
+        max_retries: int = settings.EMBED_MAX_RETRIES,
+    ) -> None:
+        self.window = window
+        self.batch_size = batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue[_PendingChunk] = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
 
-    # Upsert the document to Pinecone
-    index.upsert(vectors=[(doc.id, vector, {"id": doc.id, "text": doc.text})])
+    def start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
 
-    return vector
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
 
+    async def submit(self, chunk: Chunk) -> List[float]:
+        self.start()
+        item = _PendingChunk(chunk, asyncio.get_running_loop().create_future())
+        self._queue.put_nowait(item)
+        return await item.future
 
-def clear_all_docs(index: Pinecone.Index):
-    index.delete(delete_all=True)
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except TimeoutError:
+                    break
+            try:
+                await self._process(batch)
+            except Exception as e:
+                # Never leave a caller waiting on a batch that blew up
+                logger.error(f"Vectorising batch of {len(batch)} chunks failed: {e!r}")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
 
+    async def _process(self, batch: List[_PendingChunk]) -> None:
+        to_embed = [item for item in batch if item.vector is None and not item.future.done()]
+        if to_embed:
+            try:
+                vectors = await run_in_threadpool(
+                    embed_model.get_text_embedding_batch, [item.chunk.text for item in to_embed]
+                )
+                if len(vectors) != len(to_embed):
+                    raise ValueError(f"Got {len(vectors)} embeddings for {len(to_embed)} chunks")
+            except Exception as e:
+                self._retry(to_embed, e)
+            else:
+                for item, vector in zip(to_embed, vectors):
+                    item.vector = vector
 
-def search_text(text: str, index: Pinecone.Index) -> List[Dict[str, Any]]:
+        ready = [item for item in batch if item.vector is not None and not item.future.done()]
+        for i in range(0, len(ready), self.upsert_batch_size):
+            chunk = ready[i:i + self.upsert_batch_size]
+            try:
+                await vector_index.upsert(vectors=[
+                    (item.chunk.vector_id, item.vector, item.chunk.metadata)
+                    for item in chunk
+                ])
+            except Exception as e:
+                self._retry(chunk, e)
+            else:
+                try:
+                    await bump_search_generation()
+                except Exception as e:
+                    # The vectors are stored, cached results just live until they expire
+                    logger.error(f"Bumping the search generation failed: {e!r}")
+                for item in chunk:
+                    if not item.future.done():
+                        item.future.set_result(item.vector)
+        logger.info(f"Vectorised batch of {len(batch)} chunks ({len(to_embed)} embedded)")
+
+    def _retry(self, items: List[_PendingChunk], error: Exception) -> None:
+        logger.warning(f"Vectorising {len(items)} chunks failed: {error}")
+        loop = asyncio.get_running_loop()
+        for item in items:
+            item.attempts += 1
+            if item.attempts <= self.max_retries:
+                loop.call_later(2 ** item.attempts, self._queue.put_nowait, item)
+            elif not item.future.done():
+                logger.error(f"Giving up on vectorising chunk {item.chunk.vector_id}")
+                item.future.set_exception(error)
+
+
+embedding_batcher = EmbeddingBatcher()
+
+
+async def text_to_vector(doc: Doc) -> List[List[float]]:
+    """Index ``doc`` as overlapping chunks and drop chunks left from a longer version."""
+    chunks = chunk_doc(doc)
+    vectors = await asyncio.gather(*(embedding_batcher.submit(chunk) for chunk in chunks))
+    previous = await redis_client.hget("vector_chunks", doc.id) or 0
+    await redis_client.hset("vector_chunks", doc.id, len(chunks))
+    if previous > len(chunks):
+        await vector_index.delete([f"{doc.id}#{i}" for i in range(len(chunks), previous)])
+    return vectors
+
+
+async def clear_all_docs():
+    await vector_index.delete_all()
+    await redis_client.delete("vector_chunks")
+    await bump_search_generation()
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class QueryEmbeddingCache:
+    """Query vectors cached in a local LRU in front of a shared Redis cache.
+
+    Keys are a hash of the normalised query and the model name; Redis holds
+    the vector as raw float32 bytes.
+    """
+
+    def __init__(self, size: int = settings.QUERY_EMBED_CACHE_SIZE, ttl: int = settings.QUERY_EMBED_CACHE_TTL) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._lru: OrderedDict[str, List[float]] = OrderedDict()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(text: str) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode()).hexdigest()
+        return f"query_embedding:{model_name}:{digest}"
+
+    async def get_embedding(self, text: str) -> List[float]:
+        key = self.key(text)
+        vector = self._lru.get(key)
+        if vector is not None:
+            self._lru.move_to_end(key)
+            self.stats["local_hits"] += 1
+            return vector
+
+        raw = await redis_client.get_raw(key)
+        if raw is not None:
+            self.stats["redis_hits"] += 1
+            vector = np.frombuffer(raw, dtype=np.float32).tolist()
+        else:
+            self.stats["misses"] += 1
+            vector = await run_in_threadpool(embed_model.get_text_embedding, normalize_query(text))
+            await redis_client.set_raw(key, np.asarray(vector, dtype=np.float32).tobytes(), self.ttl)
+
+        self._lru[key] = vector
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+        return vector
+
+
+query_embedding_cache = QueryEmbeddingCache()
+
+
+SEARCH_GENERATION_KEY = "search_generation"
+
+
+async def bump_search_generation() -> None:
+    """Invalidate every cached search result, see ``SearchResultCache``."""
+    await redis_client.incr(SEARCH_GENERATION_KEY)
+
+
+class SearchResultCache:
+    """Finished ``/doc/search`` responses cached in Redis.
+
+    Keys include the current search generation, which is bumped whenever the
+    index or the indexed documents change, so a stale result is never read;
+    entries of old generations simply expire.
+    """
+
+    def __init__(self, ttl: int = settings.SEARCH_CACHE_TTL) -> None:
+        self.ttl = ttl
+
+    @staticmethod
+    def key(text: str, generation: int) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode()).hexdigest()
+        return f"search_results:{generation}:{digest}"
+
+    async def get(self, text: str) -> tuple[int, Optional[Any]]:
+        """Return the current generation and the cached result, if any."""
+        generation = await redis_client.get(SEARCH_GENERATION_KEY) or 0
+        return generation, await redis_client.get(self.key(text, generation))
+
+    async def set(self, text: str, generation: int, value: Any) -> None:
+        await redis_client.set(self.key(text, generation), value, self.ttl)
+
+
+search_result_cache = SearchResultCache()
+
+
+async def search_text(text: str, top_k: int = 9) -> List[Dict[str, Any]]:
     # Generate the vector for the search text
-    vector = embed_model.get_text_embedding(text)
+    vector = await query_embedding_cache.get_embedding(text)
 
-    results = index.query(
+    results = await vector_index.query(
         vector=vector,
-        top_k=9,  # Number of top results to return
+        top_k=top_k * settings.EMBED_CHUNK_QUERY_FACTOR,  # Several chunks may belong to one document
         include_metadata=True  # Include the metadata of the results
     )
 
-    metadata_results = [match['metadata'] for match in results['matches']]
-    return metadata_results
+    # A document scores as its best matching chunk
+    scores: Dict[str, float] = {}
+    vector_ids: Dict[str, List[str]] = {}
+    legacy = []
+    for match in results['matches']:
+        doc_id = (match['metadata'] or {}).get('doc_id')
+        if doc_id is None:
+            # Whole-document vector from before chunking, keyed by a doc_version id
+            legacy.append(match['id'])
+            continue
+        scores[doc_id] = max(scores.get(doc_id, match['score']), match['score'])
+        vector_ids.setdefault(doc_id, []).append(match['id'])
+    if legacy:
+        await report_orphan_vectors(legacy)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [{"id": doc_id, "score": score, "vector_ids": vector_ids[doc_id]} for doc_id, score in ranked]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[tuple[str, float]]:
+    """Merge ranked id lists; an id scores ``sum(1 / (k + rank))`` over the lists."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+ORPHANS_KEY = "vector_orphans"
+
+
+async def report_orphan_vectors(vector_ids: List[str]) -> None:
+    """Remember index entries whose documents are gone, see ``delete_orphan_vectors``."""
+    logger.warning(f"Vector index has no documents for vectors: {vector_ids}")
+    await redis_client.sadd(ORPHANS_KEY, *vector_ids)
+
+
+async def delete_orphan_vectors(vector_ids: List[str], batch_size: int = 1000) -> int:
+    """Delete reported orphans from the index and forget them; returns the vectors deleted.
+
+    A chunk id stands for its whole document: every chunk counted in
+    ``vector_chunks`` is deleted, not only those a search happened to match.
+    Ids without ``#`` are whole-document vectors from before chunking.
+    """
+    doc_ids = {vector_id.rsplit("#", 1)[0] for vector_id in vector_ids if "#" in vector_id}
+    to_delete = set(vector_ids)
+    for doc_id in doc_ids:
+        count = await redis_client.hget("vector_chunks", doc_id) or 0
+        to_delete.update(f"{doc_id}#{i}" for i in range(count))
+    to_delete = sorted(to_delete)
+    for i in range(0, len(to_delete), batch_size):
+        await vector_index.delete(to_delete[i:i + batch_size])
+    if doc_ids:
+        await redis_client.hdel("vector_chunks", *doc_ids)
+    if vector_ids:
+        await redis_client.srem(ORPHANS_KEY, *vector_ids)
+        await bump_search_generation()
+    return len(to_delete)
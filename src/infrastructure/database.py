@@ -0,0 +1,43 @@
+"""Database engine and Unit of Work factory.
+
+Kept out of ``src.presentation`` so application code and worker processes can
+open a Unit of Work without loading the API routers.
+"""
+
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from src.infrastructure.uow import SQLAlchemyUoW
+from config import settings
+
+
+engine = create_async_engine(
+    "postgresql+asyncpg://{}:{}@{}:{}/{}".format(
+        settings.DB_USER,
+        settings.DB_PASS,
+        settings.DB_HOST,
+        settings.DB_PORT,
+        settings.DB_NAME,
+    ),
+    future=True,
+)
+
+session_pool = async_sessionmaker(
+    bind=engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+    autocommit=False,
+)
+
+async def get_uow() -> SQLAlchemyUoW:
+    """
+    Create a new Unit of Work instance.
+
+    Returns:
+        UnitOfWork: The new Unit of Work instance.
+    """
+    return SQLAlchemyUoW(session_pool)
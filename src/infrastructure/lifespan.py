@@ -0,0 +1,74 @@
+"""Startup and shutdown of the process-wide clients, shared by the API and the job worker.
+
+Kept out of ``src.presentation`` so ``worker.py`` does not load the API routers.
+"""
+import os
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, List
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+
+from src.application.redis import redis_client
+from src.application.s3 import s3_client
+from src.application.upscale import image_preprocessor
+from src.application.streaming import stream_hub
+from src.application.vectordb import vector_index, embedding_batcher
+from src.application.vector_sync import vector_sync_worker
+
+
+
+def app_lifespan(lifespans: List):
+    @asynccontextmanager
+    async def _lifespan_manager(app: FastAPI):
+        exit_stack = AsyncExitStack()
+        async with exit_stack:
+            for lifespan in lifespans:
+                await exit_stack.enter_async_context(lifespan(app))
+            yield
+
+    return _lifespan_manager
+
+@asynccontextmanager
+async def lifespan_redis(app: FastAPI) -> AsyncIterator[None]:
+    await redis_client.connect()
+    yield
+    await redis_client.close()
+
+
+@asynccontextmanager
+async def lifespan_s3(app: FastAPI) -> AsyncIterator[None]:
+    await s3_client.connect()
+    yield
+    await s3_client.close()
+
+
+@asynccontextmanager
+async def lifespan_image_preprocessor(app: FastAPI) -> AsyncIterator[None]:
+    image_preprocessor.start()
+    yield
+    image_preprocessor.stop()
+
+
+@asynccontextmanager
+async def lifespan_stream_hub(app: FastAPI) -> AsyncIterator[None]:
+    await stream_hub.start()
+    yield
+    await stream_hub.stop()
+
+
+
+@asynccontextmanager
+async def lifespan_vector_index(app: FastAPI) -> AsyncIterator[None]:
+    await run_in_threadpool(vector_index.connect)
+    embedding_batcher.start()
+    yield
+    await embedding_batcher.stop()
+
+
+
+@asynccontextmanager
+async def lifespan_vector_sync(app: FastAPI) -> AsyncIterator[None]:
+    vector_sync_worker.start()
+    yield
+    await vector_sync_worker.stop()
@@ -1,4 +1,5 @@
 from .user import User
 from .chat import Chat
-from .doc import DocVersion, DocOrigin
-from .message import Message
\ No newline at end of file
+from .doc import DocVersion, DocOrigin, DocPage
+from .message import Message
+from .outbox import VectorOutbox
\ No newline at end of file
@@ -3,7 +3,8 @@ from datetime import datetime
 import uuid
 from typing import Optional
 
-from sqlalchemy import UUID, ForeignKey, Text, func, String, Boolean
+from sqlalchemy import UUID, ForeignKey, Text, func, String, Boolean, Computed, Index, Integer, UniqueConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .base import Base
@@ -32,10 +33,47 @@ class DocVersion(Base):
 
 class DocOrigin(Base):
     __tablename__ = "doc_origins"
+    __table_args__ = (
+        Index("ix_doc_origins_search_vector", "search_vector", postgresql_using="gin"),
+    )
     
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True)
     is_archive: Mapped[bool] = mapped_column(Boolean())
     ext: Mapped[str] = mapped_column(String(256))
     content: Mapped[Optional[str]] = mapped_column(Text())
+    # sha256 of the uploaded file, used to skip OCR of repeat uploads
+    file_hash: Mapped[Optional[str]] = mapped_column(String(64), index=True)
+    # Russian stemming plus the "simple" config for surnames, names and numbers
+    search_vector: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR(),
+        Computed(
+            "to_tsvector('russian'::regconfig, coalesce(content, '')) || "
+            "to_tsvector('simple'::regconfig, coalesce(content, ''))",
+            persisted=True,
+        ),
+        deferred=True,
+    )
+    # sha256 of the content currently in the vector index
+    indexed_content_hash: Mapped[Optional[str]] = mapped_column(String(64))
+    created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    updated_at: Mapped[datetime] = mapped_column(server_onupdate=func.now(), server_default=func.now())
+
+
+class DocPage(Base):
+    """OCR result of one page of a multi-page document."""
+    __tablename__ = "doc_pages"
+    __table_args__ = (
+        UniqueConstraint("doc_origin_id", "page_number", name="uq_doc_pages_doc_origin_id_page_number"),
+    )
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True)
+    doc_origin_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("doc_origins.id", name="fk_doc_pages_doc_origin_id"),
+        index=True,
+    )
+    page_number: Mapped[int] = mapped_column(Integer())
+    # NULL until the page is recognised; ``error`` holds the reason of the last failure
+    content: Mapped[Optional[str]] = mapped_column(Text())
+    error: Mapped[Optional[str]] = mapped_column(Text())
     created_at: Mapped[datetime] = mapped_column(server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(server_onupdate=func.now(), server_default=func.now())
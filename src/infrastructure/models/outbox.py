@@ -0,0 +1,27 @@
+from datetime import datetime
+import uuid
+from typing import Optional
+
+from sqlalchemy import UUID, BigInteger, ForeignKey, Integer, Text, func
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+
+class VectorOutbox(Base):
+    """Documents whose content changed and has to be synced to the vector index."""
+    __tablename__ = "vector_outbox"
+
+    id: Mapped[int] = mapped_column(BigInteger(), primary_key=True, autoincrement=True)
+    doc_origin_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("doc_origins.id", name="fk_vector_outbox_doc_origin_id"),
+        index=True,
+    )
+    # Claims so far; a claim pushes ``next_attempt_at`` forward by the lease
+    attempts: Mapped[int] = mapped_column(Integer(), server_default="0")
+    next_attempt_at: Mapped[datetime] = mapped_column(server_default=func.now(), index=True)
+    # Set once the entry used up its attempts; ``error`` holds the last failure
+    dead_at: Mapped[Optional[datetime]] = mapped_column()
+    error: Mapped[Optional[str]] = mapped_column(Text())
+    created_at: Mapped[datetime] = mapped_column(server_default=func.now())
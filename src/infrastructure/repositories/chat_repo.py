@@ -1,14 +1,25 @@
 """This module contains the implementation of the user repository."""
+import asyncio
+import time
+import uuid
 from datetime import date, datetime, timedelta
-from typing import Sequence
+from typing import AsyncIterator, Sequence
 
-from sqlalchemy import select, insert, update
+from loguru import logger
+from sqlalchemy import UUID, select, insert, update, delete, any_, bindparam, func, literal_column
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 
-from src.infrastructure.models import Chat, DocVersion, DocOrigin, Message
+from src.infrastructure.models import Chat, DocVersion, DocOrigin, DocPage, Message, VectorOutbox
 from src.infrastructure.repositories.base import SQLAlchemyRepo
 
 # Import functions from vectordb.py
-from src.application.vectordb import initialize_pinecone, search_text, text_to_vector
+from src.application.vectordb import (
+    search_text,
+    bump_search_generation,
+    report_orphan_vectors,
+    reciprocal_rank_fusion,
+)
+from config import settings
 
 
 class ChatRepo(SQLAlchemyRepo[Chat]):
@@ -23,13 +34,31 @@ class ChatRepo(SQLAlchemyRepo[Chat]):
         await self._session.refresh(chat)
         return chat
 
-    async def create_doc_origin(self, is_archive: bool, ext: str, content: str | None = None) -> DocOrigin:
-        doc_origin = DocOrigin(is_archive=is_archive, content=content, ext=ext)
+    async def create_doc_origin(
+        self,
+        is_archive: bool,
+        ext: str,
+        content: str | None = None,
+        file_hash: str | None = None,
+        doc_origin_id: uuid.UUID | None = None,
+    ) -> DocOrigin:
+        doc_origin = DocOrigin(is_archive=is_archive, content=content, ext=ext, file_hash=file_hash)
+        if doc_origin_id is not None:
+            doc_origin.id = doc_origin_id
         self._session.add(doc_origin)
+        if content:
+            await self._session.flush()
+            self._session.add(VectorOutbox(doc_origin_id=doc_origin.id))
         await self._session.commit()
         await self._session.refresh(doc_origin)
         return doc_origin
 
+    async def create_doc_origins(self, is_archive: bool, exts: Sequence[str]) -> list[DocOrigin]:
+        doc_origins = [DocOrigin(is_archive=is_archive, ext=ext) for ext in exts]
+        self._session.add_all(doc_origins)
+        await self._session.commit()
+        return doc_origins
+
     async def create_doc_version(self, chat_id: str, doc_origin_id: str, content: str | None = None) -> DocVersion:
         doc_version = DocVersion(
             content=content, chat_id=chat_id, doc_origin_id=doc_origin_id)
@@ -43,6 +72,32 @@ class ChatRepo(SQLAlchemyRepo[Chat]):
         result = await self._session.execute(stmt)
         return result.scalar()
 
+    async def get_doc_origin_by_file_hash(self, file_hash: str) -> DocOrigin | None:
+        """The oldest recognised document uploaded with the same file."""
+        stmt = (
+            select(DocOrigin)
+            .where(DocOrigin.file_hash == file_hash, DocOrigin.content.is_not(None))
+            .order_by(DocOrigin.created_at)
+            .limit(1)
+        )
+        result = await self._session.execute(stmt)
+        return result.scalar()
+
+    async def get_chat_title_by_doc_origin(self, doc_origin_id: str) -> str | None:
+        stmt = (
+            select(Chat.title)
+            .join(DocVersion, DocVersion.chat_id == Chat.id)
+            .where(DocVersion.doc_origin_id == doc_origin_id, Chat.title.is_not(None))
+            .limit(1)
+        )
+        result = await self._session.execute(stmt)
+        return result.scalar()
+
+    async def get_doc_version_by_id(self, doc_version_id: str) -> DocVersion:
+        stmt = select(DocVersion).where(DocVersion.id == doc_version_id)
+        result = await self._session.execute(stmt)
+        return result.scalar()
+
     async def create_message(self, chat_id: str, content: str, is_user: bool) -> Message:
         message = Message(content=content, chat_id=chat_id, is_user=is_user)
         self._session.add(message)
@@ -58,8 +113,11 @@ class ChatRepo(SQLAlchemyRepo[Chat]):
             .returning(DocVersion)
         )
         resp = await self._session.execute(stmt)
+        doc_version = resp.scalar()
+        if doc_version:
+            self._session.add(VectorOutbox(doc_origin_id=doc_version.doc_origin_id))
         await self._session.commit()
-        return resp.scalar()
+        return doc_version
 
     async def edit_doc_origin(self, doc_origin_id: str, content: str) -> None:
         stmt = (
@@ -68,19 +126,242 @@ class ChatRepo(SQLAlchemyRepo[Chat]):
             .values(dict(content=content))
         )
         await self._session.execute(stmt)
+        self._session.add(VectorOutbox(doc_origin_id=doc_origin_id))
         await self._session.commit()
+        await bump_search_generation()
+
+    async def create_doc_pages(self, doc_origin_id: str, page_count: int) -> None:
+        stmt = (
+            pg_insert(DocPage)
+            .values([
+                dict(id=uuid.uuid4(), doc_origin_id=doc_origin_id, page_number=page_number)
+                for page_number in range(page_count)
+            ])
+            .on_conflict_do_nothing(index_elements=[DocPage.doc_origin_id, DocPage.page_number])
+        )
+        await self._session.execute(stmt)
+        await self._session.commit()
+
+    async def set_doc_page_result(
+        self, doc_origin_id: str, page_number: int, content: str | None, error: str | None = None
+    ) -> None:
+        stmt = (
+            update(DocPage)
+            .where(DocPage.doc_origin_id == doc_origin_id, DocPage.page_number == page_number)
+            .values(dict(content=content, error=error))
+        )
+        await self._session.execute(stmt)
+        await self._session.commit()
+
+    async def get_doc_pages(self, doc_origin_id: str) -> Sequence[DocPage]:
+        stmt = (
+            select(DocPage)
+            .where(DocPage.doc_origin_id == doc_origin_id)
+            .order_by(DocPage.page_number)
+        )
+        result = await self._session.execute(stmt)
+        return result.scalars().all()
+
+    async def enqueue_vector_sync(self, doc_origin_ids: Sequence[str], force: bool = False) -> None:
+        """Queue documents for the vector sync worker.
+
+        With ``force`` their indexed hash is dropped, so they are re-embedded
+        even if the content did not change since they were last indexed.
+        """
+        if force:
+            await self.reset_indexed_content_hashes(doc_origin_ids)
+        self._session.add_all([VectorOutbox(doc_origin_id=doc_origin_id) for doc_origin_id in doc_origin_ids])
+        await self._session.commit()
+
+    async def reset_indexed_content_hashes(self, doc_origin_ids: Sequence[str] | None = None) -> None:
+        """Forget which content is indexed, for the given documents or for all of them."""
+        stmt = update(DocOrigin).values(dict(indexed_content_hash=None))
+        if doc_origin_ids is not None:
+            stmt = stmt.where(DocOrigin.id.in_([uuid.UUID(str(doc_origin_id)) for doc_origin_id in doc_origin_ids]))
+        await self._session.execute(stmt)
+
+    async def claim_vector_outbox(self, limit: int, lease: float) -> Sequence[VectorOutbox]:
+        """Lease the oldest due outbox entries for ``lease`` seconds and commit.
+
+        Entries claimed by other workers are skipped. No lock is held after
+        this returns; if the worker dies the entries are due again once the
+        lease runs out.
+        """
+        due = (
+            select(VectorOutbox.id)
+            .where(VectorOutbox.dead_at.is_(None), VectorOutbox.next_attempt_at <= func.now())
+            .order_by(VectorOutbox.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(VectorOutbox)
+            .where(VectorOutbox.id.in_(due.scalar_subquery()))
+            .values(
+                attempts=VectorOutbox.attempts + 1,
+                next_attempt_at=func.now() + timedelta(seconds=lease),
+            )
+            .returning(VectorOutbox)
+            .execution_options(synchronize_session=False)
+        )
+        result = await self._session.execute(stmt)
+        entries = result.scalars().all()
+        await self._session.commit()
+        return entries
+
+    async def delete_vector_outbox(self, outbox_ids: Sequence[int]) -> None:
+        stmt = delete(VectorOutbox).where(VectorOutbox.id.in_(outbox_ids))
+        await self._session.execute(stmt)
+
+    async def retry_vector_outbox(self, outbox_ids: Sequence[int], delay: float, error: str) -> None:
+        stmt = (
+            update(VectorOutbox)
+            .where(VectorOutbox.id.in_(outbox_ids))
+            .values(next_attempt_at=func.now() + timedelta(seconds=delay), error=error)
+        )
+        await self._session.execute(stmt)
+
+    async def bury_vector_outbox(self, outbox_ids: Sequence[int], error: str) -> None:
+        """Dead-letter entries: they stay in the table but are never claimed again."""
+        stmt = (
+            update(VectorOutbox)
+            .where(VectorOutbox.id.in_(outbox_ids))
+            .values(dead_at=func.now(), error=error)
+        )
+        await self._session.execute(stmt)
+
+    async def requeue_dead_vector_outbox(self) -> int:
+        stmt = (
+            update(VectorOutbox)
+            .where(VectorOutbox.dead_at.is_not(None))
+            .values(dead_at=None, attempts=0, next_attempt_at=func.now())
+        )
+        result = await self._session.execute(stmt)
+        await self._session.commit()
+        return result.rowcount
+
+    async def set_indexed_content_hash(self, doc_origin_id: str, content_hash: str) -> None:
+        stmt = (
+            update(DocOrigin)
+            .where(DocOrigin.id == doc_origin_id)
+            .values(dict(indexed_content_hash=content_hash))
+        )
+        await self._session.execute(stmt)
+
+    async def stream_doc_origins(
+        self, after_id: str | None = None, batch_size: int = 500
+    ) -> AsyncIterator[tuple[uuid.UUID, str]]:
+        """Yield ``(id, content)`` of documents with content in id order, via a server-side cursor."""
+        stmt = (
+            select(DocOrigin.id, DocOrigin.content)
+            .where(DocOrigin.content.is_not(None))
+            .order_by(DocOrigin.id)
+            .execution_options(yield_per=batch_size)
+        )
+        if after_id is not None:
+            stmt = stmt.where(DocOrigin.id > after_id)
+        result = await self._session.stream(stmt)
+        async for doc_origin_id, content in result:
+            yield doc_origin_id, content
+
+    async def set_indexed_content_hashes(self, content_hashes: dict[str, str]) -> None:
+        await self._session.execute(
+            update(DocOrigin),
+            [
+                {"id": uuid.UUID(str(doc_origin_id)), "indexed_content_hash": content_hash}
+                for doc_origin_id, content_hash in content_hashes.items()
+            ],
+        )
+        await self._session.commit()
+
+    async def get_doc_origins_by_ids(self, doc_origin_ids: Sequence[str]) -> dict[str, DocOrigin]:
+        ids = []
+        for doc_origin_id in doc_origin_ids:
+            try:
+                ids.append(uuid.UUID(doc_origin_id))
+            except ValueError:
+                continue
+        if not ids:
+            return {}
+        stmt = select(DocOrigin).where(
+            DocOrigin.id == any_(bindparam("ids", ids, type_=ARRAY(UUID(as_uuid=True))))
+        )
+        result = await self._session.execute(stmt)
+        return {str(doc_origin.id): doc_origin for doc_origin in result.scalars()}
+
+    async def search_doc_in_vectordb(self, text: str) -> list[tuple[DocOrigin, float]]:
+        """Return found documents with their similarity scores, best first."""
+        search_results = await search_text(text)
+        doc_origins = await self.get_doc_origins_by_ids([result['id'] for result in search_results])
+        missing = [
+            vector_id
+            for result in search_results if result['id'] not in doc_origins
+            for vector_id in result['vector_ids']
+        ]
+        if missing:
+            await report_orphan_vectors(missing)
+        return [
+            (doc_origins[result['id']], result['score'])
+            for result in search_results
+            if result['id'] in doc_origins
+        ]
+
+    async def search_doc_lexical(self, text: str, limit: int = settings.SEARCH_LEXICAL_LIMIT) -> list[tuple[str, float]]:
+        """Full-text search over ``DocOrigin.search_vector``, best first."""
+        tsquery = func.websearch_to_tsquery(literal_column("'russian'::regconfig"), text).op("||")(
+            func.websearch_to_tsquery(literal_column("'simple'::regconfig"), text)
+        )
+        rank = func.ts_rank_cd(DocOrigin.search_vector, tsquery)
+        stmt = (
+            select(DocOrigin.id, rank)
+            .where(DocOrigin.search_vector.op("@@")(tsquery))
+            .order_by(rank.desc())
+            .limit(limit)
+        )
+        result = await self._session.execute(stmt)
+        return [(str(doc_origin_id), score) for doc_origin_id, score in result.all()]
+
+    async def search_docs(self, text: str, limit: int = 9) -> tuple[list[tuple[DocOrigin, float]], bool]:
+        """Hybrid search: lexical and vector results merged with reciprocal-rank fusion.
+
+        Both legs run concurrently. If the vector leg fails or does not finish
+        within ``SEARCH_VECTOR_TIMEOUT`` seconds the lexical results are used
+        alone and the result is flagged as degraded.
+
+        Returns:
+            The documents with their fused scores, best first, and the degraded flag.
+        """
+        deadline = time.monotonic() + settings.SEARCH_VECTOR_TIMEOUT
+        vector_search = asyncio.create_task(search_text(text))
+        try:
+            lexical_ids = [doc_id for doc_id, _ in await self.search_doc_lexical(text)]
+        except BaseException:
+            vector_search.cancel()
+            raise
+        try:
+            vector_results = await asyncio.wait_for(vector_search, max(deadline - time.monotonic(), 0))
+            degraded = False
+        except Exception as e:
+            logger.warning(f"Vector search unavailable, using lexical results only: {e!r}")
+            vector_results = []
+            degraded = True
+        vector_ids = [result['id'] for result in vector_results]
+
+        fused = reciprocal_rank_fusion([lexical_ids, vector_ids])
+        # Every vector hit is looked up so only ids without a row count as
+        # orphans, plus enough runners-up to fill ``limit`` if some are
+        candidates = {doc_id for doc_id, _ in fused[:limit + len(vector_ids)]} | set(vector_ids)
+        doc_origins = await self.get_doc_origins_by_ids(list(candidates))
+        missing = [
+            vector_id
+            for result in vector_results if result['id'] not in doc_origins
+            for vector_id in result['vector_ids']
+        ]
+        if missing:
+            await report_orphan_vectors(missing)
+        hits = [(doc_origins[doc_id], score) for doc_id, score in fused if doc_id in doc_origins][:limit]
+        return hits, degraded
 
-    async def search_doc_in_vectordb(self, text: str) -> Sequence[DocOrigin]:
-        index = initialize_pinecone()
-        search_results = search_text(text, index)
-        doc_origins = []
-        for result in search_results:
-            doc_origin_id = result['id']
-            doc_origin = await self.get_doc_origin_by_id(doc_origin_id)
-            if doc_origin:
-                doc_origins.append(doc_origin)
-        return doc_origins
-    
     async def get_user_chats(self, user_id: str) -> list[Chat]:
         stmt = (
             select(Chat)
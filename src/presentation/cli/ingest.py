@@ -0,0 +1,230 @@
+"""Bulk ingestion of archive scans from a directory or a zip file.
+
+    python -m src.presentation.cli.ingest SOURCE [--manifest PATH]
+        [--batch-size 100] [--upload-concurrency 16] [--ocr-concurrency 8]
+
+Every scan becomes an archive ``DocOrigin``: the rows are created in
+batches, files are uploaded to S3 and recognised by a bounded pool, and the
+text is stored through ``edit_doc_origin`` so the vector outbox picks it up;
+the outbox is drained in batches while the run goes on. Progress is
+appended to a JSONL manifest (``SOURCE.manifest.jsonl`` by default) and a
+rerun skips finished files and reuses the rows of started ones.
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import zipfile
+from contextlib import suppress
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Iterator
+
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
+
+from src.application.pages import ocr_document
+from src.application.redis import redis_client
+from src.application.s3 import s3_client, upload_file_to_s3
+from src.application.upscale import image_preprocessor
+from src.application.vectordb import vector_index, embedding_batcher
+from src.application.vector_sync import VectorSyncWorker, sync_vector_outbox
+from src.infrastructure.database import get_uow
+from config import settings
+
+
+SCAN_EXTENSIONS = {"jpg", "jpeg", "png", "tif", "tiff", "webp", "bmp", "gif", "pdf"}
+
+
+@dataclass
+class ScanFile:
+    name: str
+    ext: str
+    read: Callable[[], bytes]
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def iter_scans(source: str) -> Iterator[ScanFile]:
+    """Scans under a directory or inside a zip, in name order."""
+    def ext_of(name: str) -> str:
+        return name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+    if zipfile.is_zipfile(source):
+        archive = zipfile.ZipFile(source)
+        lock = threading.Lock()
+
+        def reader(name: str) -> Callable[[], bytes]:
+            def read() -> bytes:
+                with lock:
+                    return archive.read(name)
+            return read
+
+        for name in sorted(archive.namelist()):
+            if ext_of(name) in SCAN_EXTENSIONS:
+                yield ScanFile(name, ext_of(name), reader(name))
+        return
+
+    paths = []
+    for root, _, files in os.walk(source):
+        paths.extend(os.path.join(root, name) for name in files if ext_of(name) in SCAN_EXTENSIONS)
+    for path in sorted(paths):
+        name = os.path.relpath(path, source)
+        yield ScanFile(name, ext_of(name), partial(read_file, path))
+
+
+class Manifest:
+    """Append-only JSONL record of ``{"name", "doc_origin_id", "status", "error"}``."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry["name"]] = entry
+        self._file = open(path, "a")
+
+    def record(self, name: str, doc_origin_id: str, status: str, error: str | None = None) -> None:
+        entry = {"name": name, "doc_origin_id": doc_origin_id, "status": status, "error": error}
+        self.entries[name] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class Ingestion:
+    def __init__(self, manifest: Manifest, upload_concurrency: int, ocr_concurrency: int) -> None:
+        self.manifest = manifest
+        self.upload_slots = asyncio.Semaphore(upload_concurrency)
+        self.ocr_slots = asyncio.Semaphore(ocr_concurrency)
+        # Bounds the files held in memory between reading and upload
+        self.in_flight = asyncio.Semaphore(upload_concurrency + ocr_concurrency)
+        self.tasks: set[asyncio.Task] = set()
+        self.done = 0
+        self.skipped = 0
+        self.failures: dict[str, str] = {}
+        self.uploaded_bytes = 0
+
+    async def run(self, scans: Iterator[ScanFile], batch_size: int) -> None:
+        batch = []
+        for scan in scans:
+            entry = self.manifest.entries.get(scan.name)
+            if entry and entry["status"] == "done":
+                self.skipped += 1
+                continue
+            batch.append(scan)
+            if len(batch) >= batch_size:
+                await self.start_batch(batch)
+                batch = []
+        if batch:
+            await self.start_batch(batch)
+        await asyncio.gather(*self.tasks)
+
+    async def start_batch(self, scans: list[ScanFile]) -> None:
+        new = [scan for scan in scans if scan.name not in self.manifest.entries]
+        if new:
+            uow = await get_uow()
+            async with uow:
+                doc_origins = await uow.chat_repo.create_doc_origins(True, [scan.ext for scan in new])
+            for scan, doc_origin in zip(new, doc_origins):
+                self.manifest.record(scan.name, str(doc_origin.id), "created")
+        for scan in scans:
+            await self.in_flight.acquire()
+            task = asyncio.create_task(self.ingest(scan, self.manifest.entries[scan.name]["doc_origin_id"]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def ingest(self, scan: ScanFile, doc_origin_id: str) -> None:
+        object_name = f"{doc_origin_id}.{scan.ext}"
+        try:
+            if self.manifest.entries[scan.name]["status"] != "uploaded":
+                async with self.upload_slots:
+                    content = await run_in_threadpool(scan.read)
+                    if not await upload_file_to_s3(content, settings.AWS_BUCKET_NAME, object_name):
+                        raise RuntimeError("S3 upload failed")
+                    self.uploaded_bytes += len(content)
+                    del content
+                self.manifest.record(scan.name, doc_origin_id, "uploaded")
+            async with self.ocr_slots:
+                text = await ocr_document(settings.AWS_BUCKET_NAME, object_name, doc_origin_id, key=scan.name)
+            uow = await get_uow()
+            async with uow:
+                await uow.chat_repo.edit_doc_origin(doc_origin_id, text)
+            self.manifest.record(scan.name, doc_origin_id, "done")
+            self.done += 1
+        except Exception as e:
+            logger.error(f"Ingesting {scan.name} failed: {e!r}")
+            self.failures[scan.name] = repr(e)
+            self.manifest.record(scan.name, doc_origin_id, "failed", repr(e))
+        finally:
+            self.in_flight.release()
+
+
+async def report(ingestion: Ingestion, started: float, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"{ingestion.done} done, {len(ingestion.failures)} failed, {ingestion.skipped} skipped, "
+            f"{ingestion.done / elapsed * 60:.1f} docs/min, "
+            f"{ingestion.uploaded_bytes / elapsed / 2**20:.2f} MiB/s uploaded"
+        )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory or zip file with scans")
+    parser.add_argument("--manifest", help="progress file, SOURCE.manifest.jsonl by default")
+    parser.add_argument("--batch-size", type=int, default=100, help="doc origins created per transaction")
+    parser.add_argument("--upload-concurrency", type=int, default=16)
+    parser.add_argument("--ocr-concurrency", type=int, default=8)
+    parser.add_argument("--report-interval", type=float, default=30.0)
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest or f"{args.source.rstrip('/')}.manifest.jsonl")
+    ingestion = Ingestion(manifest, args.upload_concurrency, args.ocr_concurrency)
+    await redis_client.connect()
+    await s3_client.connect()
+    image_preprocessor.start()
+    await run_in_threadpool(vector_index.connect)
+    vector_sync = VectorSyncWorker()
+    vector_sync.start()
+    started = time.monotonic()
+    reporter = asyncio.create_task(report(ingestion, started, args.report_interval))
+    try:
+        await ingestion.run(iter_scans(args.source), args.batch_size)
+        await vector_sync.stop()
+        # Embed whatever the background sync has not picked up yet
+        while await sync_vector_outbox():
+            pass
+    finally:
+        reporter.cancel()
+        with suppress(asyncio.CancelledError):
+            await reporter
+        manifest.close()
+        await embedding_batcher.stop()
+        image_preprocessor.stop()
+        await s3_client.close()
+        await redis_client.close()
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Ingested {ingestion.done} scans in {elapsed:.0f}s "
+        f"({ingestion.done / max(elapsed, 1e-9) * 60:.1f} docs/min), "
+        f"{ingestion.skipped} already done, {len(ingestion.failures)} failed"
+    )
+    for name, error in sorted(ingestion.failures.items()):
+        print(f"  FAILED {name}: {error}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+"""Rebuild the vector index from Postgres.
+
+    python -m src.presentation.cli.reindex [--clear] [--restart] [--concurrency 64]
+    python -m src.presentation.cli.reindex --requeue-dead
+    python -m src.presentation.cli.reindex --delete-orphans
+
+Documents are streamed in id order through a server-side cursor and indexed
+with at most ``--concurrency`` in flight (the embedding batcher groups them
+into batch calls). The highest id below which every document is indexed is
+checkpointed in Redis, so an interrupted run resumes where it stopped.
+A document that fails is handed to the vector sync worker before the
+checkpoint may pass it. ``--delete-orphans`` removes the vectors searches
+reported as having no document, including whole-document vectors left from
+before chunking.
+"""
+import argparse
+import asyncio
+import time
+from collections import deque
+
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
+
+from src.application.redis import redis_client
+from src.application.vectordb import (
+    ORPHANS_KEY,
+    vector_index,
+    embedding_batcher,
+    text_to_vector,
+    clear_all_docs,
+    delete_orphan_vectors,
+    Doc,
+)
+from src.application.vector_sync import content_hash
+from src.infrastructure.database import get_uow
+
+
+CHECKPOINT_KEY = "reindex:checkpoint"
+
+
+class Progress:
+    """Tracks in-flight documents and the contiguous prefix that is done."""
+
+    def __init__(self) -> None:
+        self.pending: deque[list] = deque()
+        self.checkpoint: str | None = None
+        self.hashes: dict[str, str] = {}
+        self.indexed = 0
+        self.failed: list[str] = []
+        self.stuck = 0
+
+    def add(self, doc_origin_id: str) -> list:
+        entry = [doc_origin_id, False]
+        self.pending.append(entry)
+        return entry
+
+    def advance(self) -> None:
+        while self.pending and self.pending[0][1]:
+            self.checkpoint = self.pending.popleft()[0]
+
+
+async def index_doc(doc: Doc, entry: list, progress: Progress, semaphore: asyncio.Semaphore) -> None:
+    try:
+        try:
+            await text_to_vector(doc)
+        except Exception as e:
+            logger.error(f"Indexing doc {doc.id} failed: {e!r}")
+            progress.failed.append(doc.id)
+            # Left to the vector sync worker to retry
+            uow = await get_uow()
+            async with uow:
+                await uow.chat_repo.enqueue_vector_sync([doc.id], force=True)
+        else:
+            progress.hashes[doc.id] = content_hash(doc.text)
+            progress.indexed += 1
+        entry[1] = True
+        progress.advance()
+    except Exception as e:
+        # The checkpoint stays before this doc, the next run picks it up
+        logger.error(f"Queueing doc {doc.id} for vector sync failed: {e!r}")
+        progress.stuck += 1
+    finally:
+        semaphore.release()
+
+
+async def save_checkpoint(progress: Progress) -> None:
+    if progress.hashes:
+        hashes, progress.hashes = progress.hashes, {}
+        uow = await get_uow()
+        async with uow:
+            await uow.chat_repo.set_indexed_content_hashes(hashes)
+    if progress.checkpoint is not None:
+        await redis_client.set(CHECKPOINT_KEY, progress.checkpoint, expire=0)
+
+
+async def reindex(clear: bool, restart: bool, concurrency: int, report_interval: float) -> None:
+    if clear:
+        logger.info("Clearing the vector index")
+        await clear_all_docs()
+        uow = await get_uow()
+        async with uow:
+            await uow.chat_repo.reset_indexed_content_hashes()
+            await uow.commit()
+    if clear or restart:
+        await redis_client.delete(CHECKPOINT_KEY)
+    after_id = await redis_client.get(CHECKPOINT_KEY)
+    if after_id:
+        logger.info(f"Resuming after doc {after_id}")
+
+    progress = Progress()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    started = last_report = time.monotonic()
+    uow = await get_uow()
+    async with uow:
+        async for doc_origin_id, content in uow.chat_repo.stream_doc_origins(after_id):
+            await semaphore.acquire()
+            doc_origin_id = str(doc_origin_id)
+            task = asyncio.create_task(
+                index_doc(Doc(content, doc_origin_id), progress.add(doc_origin_id), progress, semaphore)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if time.monotonic() - last_report >= report_interval:
+                last_report = time.monotonic()
+                await save_checkpoint(progress)
+                elapsed = last_report - started
+                logger.info(
+                    f"Indexed {progress.indexed} docs ({len(progress.failed)} failed), "
+                    f"{progress.indexed / elapsed:.1f} docs/s"
+                )
+    await asyncio.gather(*tasks)
+    await save_checkpoint(progress)
+    if progress.stuck:
+        logger.warning(f"{progress.stuck} failed docs could not be queued, run again to resume from the checkpoint")
+    else:
+        await redis_client.delete(CHECKPOINT_KEY)
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Done: {progress.indexed} docs indexed, {len(progress.failed)} failed in {elapsed:.0f}s "
+        f"({progress.indexed / max(elapsed, 1e-9):.1f} docs/s)"
+    )
+
+
+async def delete_orphans() -> None:
+    vector_ids = await redis_client.smembers(ORPHANS_KEY)
+    # A document may have been created since its vectors were reported
+    doc_ids = [vector_id.rsplit("#", 1)[0] for vector_id in vector_ids if "#" in vector_id]
+    uow = await get_uow()
+    async with uow:
+        existing = await uow.chat_repo.get_doc_origins_by_ids(doc_ids)
+    stale = [vector_id for vector_id in vector_ids if vector_id.rsplit("#", 1)[0] in existing]
+    if stale:
+        await redis_client.srem(ORPHANS_KEY, *stale)
+    orphans = [vector_id for vector_id in vector_ids if vector_id.rsplit("#", 1)[0] not in existing]
+    count = await delete_orphan_vectors(orphans)
+    logger.info(f"Deleted {count} orphan vectors, {len(stale)} reports were stale")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clear", action="store_true", help="delete every vector before indexing")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    parser.add_argument("--concurrency", type=int, default=64, help="documents in flight")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="seconds between progress reports")
+    parser.add_argument(
+        "--requeue-dead", action="store_true", help="retry the dead-lettered vector outbox entries and exit"
+    )
+    parser.add_argument(
+        "--delete-orphans", action="store_true", help="delete the vectors reported as orphans and exit"
+    )
+    args = parser.parse_args()
+
+    if args.requeue_dead:
+        uow = await get_uow()
+        async with uow:
+            count = await uow.chat_repo.requeue_dead_vector_outbox()
+        logger.info(f"Requeued {count} dead outbox entries")
+        return
+
+    await redis_client.connect()
+    await run_in_threadpool(vector_index.connect)
+    try:
+        if args.delete_orphans:
+            await delete_orphans()
+        else:
+            await reindex(args.clear, args.restart, args.concurrency, args.report_interval)
+    finally:
+        await embedding_batcher.stop()
+        await redis_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -7,47 +7,13 @@ from datetime import datetime, timedelta, timezone
 import jwt
 from fastapi import Depends, HTTPException, status, Request, Response
 from jwt import InvalidTokenError
-from sqlalchemy.ext.asyncio import (
-    AsyncEngine,
-    AsyncSession,
-    async_sessionmaker,
-    create_async_engine,
-)
 
 from src.infrastructure.models import User
 from src.infrastructure.uow import SQLAlchemyUoW
+from src.infrastructure.database import get_uow
 from config import settings
 
 
-engine = create_async_engine(
-    "postgresql+asyncpg://{}:{}@{}:{}/{}".format(
-        settings.DB_USER,
-        settings.DB_PASS,
-        settings.DB_HOST,
-        settings.DB_PORT,
-        settings.DB_NAME,
-    ),
-    future=True,
-)
-
-session_pool = async_sessionmaker(
-    bind=engine,
-    class_=AsyncSession,
-    autoflush=False,
-    expire_on_commit=False,
-    autocommit=False,
-)
-
-async def get_uow() -> SQLAlchemyUoW:
-    """
-    Create a new Unit of Work instance.
-
-    Returns:
-        UnitOfWork: The new Unit of Work instance.
-    """
-    return SQLAlchemyUoW(session_pool)
-
-
 async def get_user_id(
     request: Request,
     response: Response,
@@ -1,41 +1,77 @@
 from typing import Annotated
 from itertools import chain
 import asyncio
+import hashlib
+import uuid
 
-from fastapi import APIRouter, UploadFile, File, Depends, WebSocket, BackgroundTasks
+from fastapi import APIRouter, UploadFile, File, Depends, WebSocket, Query, HTTPException
 from pydantic import UUID4
 from loguru import logger
 
 from src.infrastructure.uow import SQLAlchemyUoW
 from src.infrastructure.models import Chat, DocOrigin, DocVersion
-from src.application.s3 import upload_s3_and_ocr, get_download_link_from_s3_cached
+from src.application.s3 import (
+    upload_stream_to_s3,
+    get_download_link_from_s3_cached,
+    get_download_links_from_s3_cached,
+)
+from src.application.jobs import job_queue
 from src.presentation.di import get_uow, get_user_id
-from ..schemas.chat import NewChatOut, NewMessageIn, NewMessageOut, ChatOut, DocVersionOut, MessageOut
+from ..schemas.chat import NewChatOut, NewMessageIn, NewMessageOut, ChatOut, DocVersionOut, MessageOut, JobOut
 from config import settings
 from src.application.redis import redis_client
-from src.application.chatgpt import generate_answer, rewrite_doc
+from src.application.chatgpt import generate_answer
+from src.application.streaming import stream_hub, stream_is_live
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 @router.post("/new")
 async def new(
     file: UploadFile = File(...),
     uow: Annotated[SQLAlchemyUoW, Depends(get_uow)] = ...,
     user_id: Annotated[int, Depends(get_user_id)] = ...,
-    background_tasks: BackgroundTasks = ...,
 ) -> NewChatOut:
     ext = file.filename.rsplit('.', 1)[1]
+    # Hash the upload from its spool file, repeat scans reuse an earlier OCR result
+    digest = hashlib.sha256()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+    file_hash = digest.hexdigest()
+    await file.seek(0)
     async with uow:
+        duplicate = await uow.chat_repo.get_doc_origin_by_file_hash(file_hash)
+        if not duplicate:
+            # Upload before any row is created, a failed upload leaves nothing behind.
+            # Ending the read transaction returns the connection to the pool meanwhile.
+            await uow.rollback()
+            doc_origin_id = uuid.uuid4()
+            object_name = f"{doc_origin_id}.{ext}"
+            if not await upload_stream_to_s3(file.read, settings.AWS_BUCKET_NAME, object_name):
+                raise HTTPException(status_code=502, detail="File upload failed")
         chat = await uow.chat_repo.create_chat(user_id)
         chat_id = chat.id
+        if duplicate:
+            chat.title = await uow.chat_repo.get_chat_title_by_doc_origin(duplicate.id)
         message = await uow.chat_repo.create_message(chat_id, "Если есть вопросы или нужно ввести правки напишите сюда запрос", False)
-        doc_origin = await uow.chat_repo.create_doc_origin(False, ext=ext)
-        doc_origin_id = doc_origin.id
+        if duplicate:
+            # Same S3 object, text and vectors; the stream is served from the stored text
+            logger.info(f"Upload matches doc origin {duplicate.id}, skipping OCR")
+            doc_version = await uow.chat_repo.create_doc_version(chat_id, duplicate.id, duplicate.content)
+            return NewChatOut(chat_id=chat_id, doc_version_id=doc_version.id)
+        await uow.chat_repo.create_doc_origin(False, ext=ext, file_hash=file_hash, doc_origin_id=doc_origin_id)
         doc_version = await uow.chat_repo.create_doc_version(chat_id, doc_origin_id)
         doc_version_id = doc_version.id
     await redis_client.sadd("active_streams", str(doc_version_id))
-    background_tasks.add_task(upload_s3_and_ocr, await file.read(), settings.AWS_BUCKET_NAME, f"{doc_origin_id}.{ext}", str(doc_version_id))
+    await job_queue.enqueue(
+        "ocr",
+        bucket_name=settings.AWS_BUCKET_NAME,
+        object_name=object_name,
+        doc_origin_id=str(doc_origin_id),
+        doc_version_id=str(doc_version_id),
+    )
     return NewChatOut(chat_id=chat_id, doc_version_id=doc_version_id)
 
 
@@ -43,22 +79,30 @@ async def new(
 async def streaming(
     doc_version_id: UUID4,
     websocket: WebSocket,
+    offset: Annotated[int, Query(alias="from", ge=0)] = 0,
+    uow: Annotated[SQLAlchemyUoW, Depends(get_uow)] = ...,
 ):
     doc_version_id = str(doc_version_id)
-    logger.info(f"Stream {doc_version_id}")
+    logger.info(f"Stream {doc_version_id} from {offset}")
     await websocket.accept()
-    while True:
-        data = await redis_client.lpop(f"stream:{doc_version_id}", 100)
-        text = ""
-        if data:
-            text = "".join(data)
-        if text:
-            await websocket.send_text(text)
-            logger.info(f"Stream {doc_version_id} text: {text}")
-        if not redis_client.sismember("acitve_streams", str(doc_version_id)):
-            logger.info(f"Stream {doc_version_id} leaving")
-            break
-        await asyncio.sleep(0.3)
+    if not await stream_is_live(doc_version_id):
+        # The stream has finished and expired, its text is in Postgres by now
+        async with uow:
+            doc_version = await uow.chat_repo.get_doc_version_by_id(doc_version_id)
+        if doc_version and doc_version.content:
+            await websocket.send_text(doc_version.content[offset:])
+        await websocket.send_text("[close]")
+        await websocket.close()
+        return
+    async with stream_hub.subscribe(doc_version_id, offset) as subscription:
+        while not subscription.closed:
+            text = await subscription.read(settings.STREAM_HEARTBEAT_INTERVAL)
+            if text is None:
+                # Heartbeat: an empty frame keeps proxies from dropping the socket
+                await websocket.send_text("")
+            elif text:
+                await websocket.send_text(text)
+    logger.info(f"Stream {doc_version_id} leaving")
     await websocket.send_text("[close]")
     await websocket.close()
 
@@ -67,7 +111,6 @@ async def streaming(
 async def message(
     data: NewMessageIn,
     uow: Annotated[SQLAlchemyUoW, Depends(get_uow)] = ...,
-    background_tasks: BackgroundTasks = ...,
 ) -> NewMessageOut:
     chat_id = str(data.chat_id)
     async with uow:
@@ -103,8 +146,9 @@ async def message(
             new_doc_version_id = None
 
     if rewrite_requested:
-        background_tasks.add_task(
-            rewrite_doc, origin_content, data.content, new_doc_version_id)
+        await redis_client.sadd("active_streams", new_doc_version_id)
+        await job_queue.enqueue(
+            "rewrite", content=origin_content, prompt=data.content, doc_version_id=new_doc_version_id)
 
     return NewMessageOut(content=content, new_doc_version_id=new_doc_version_id)
 
@@ -116,15 +160,18 @@ async def chat_list(
 ) -> list[ChatOut]:
     resp = []
     async with uow:
-        for chat in await uow.chat_repo.get_user_chats(user_id):
-            doc_origin = chat.doc_versions[0].doc_origin
-            object_name = f"{doc_origin.id}.{doc_origin.ext}"
-            image_url = await get_download_link_from_s3_cached(settings.AWS_BUCKET_NAME, object_name)
+        chats = await uow.chat_repo.get_user_chats(user_id)
+        object_names = {
+            chat.id: f"{chat.doc_versions[0].doc_origin.id}.{chat.doc_versions[0].doc_origin.ext}"
+            for chat in chats
+        }
+        image_urls = await get_download_links_from_s3_cached(settings.AWS_BUCKET_NAME, list(object_names.values()))
+        for chat in chats:
             chat_out = ChatOut(
                 id=chat.id,
                 title=chat.title,
                 created_at=chat.created_at,
-                image_url=image_url,
+                image_url=image_urls[object_names[chat.id]],
                 doc_versions=[
                     DocVersionOut(
                         id=dv.id,
@@ -148,6 +195,21 @@ async def chat_list(
     return resp
 
 
+@router.post("/retry_pages/{doc_version_id}")
+async def retry_pages(
+    doc_version_id: UUID4,
+    uow: Annotated[SQLAlchemyUoW, Depends(get_uow)] = ...,
+) -> JobOut:
+    """Queue OCR of the failed pages of a multi-page document; the new text lands in the doc version."""
+    doc_version_id = str(doc_version_id)
+    async with uow:
+        if not await uow.chat_repo.get_doc_version_by_id(doc_version_id):
+            raise HTTPException(status_code=404, detail="Doc version not found")
+    job_id = await job_queue.enqueue(
+        "retry_pages", bucket_name=settings.AWS_BUCKET_NAME, doc_version_id=doc_version_id)
+    return JobOut(job_id=job_id)
+
+
 @router.get("/{chat_id}")
 async def get_chat(
     chat_id: UUID4,
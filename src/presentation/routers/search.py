@@ -9,12 +9,12 @@ from pydantic import UUID4
 from loguru import logger
 
 from src.infrastructure.uow import SQLAlchemyUoW
-from src.application.s3 import upload_s3_and_ocr
 from src.application.text_to_pdf import text_to_pdf
 from src.presentation.di import get_uow, get_user_id
-from ..schemas.search import DocOriginOut, DocVersionIn, SearchOut, SearchIn, DocVersionOut, DocIn, ChatFromSearchIn, ChatFromSearchOut
+from ..schemas.search import DocOriginOut, DocVersionIn, SearchOut, SearchHitOut, SearchIn, DocVersionOut, DocIn, ChatFromSearchIn, ChatFromSearchOut
 from config import settings
 from src.application.redis import redis_client
+from src.application.vectordb import search_result_cache
 
 
 router = APIRouter(prefix="/doc", tags=["doc"])
@@ -42,20 +42,27 @@ async def search_from_vectordb(
     data: SearchIn,
     uow: Annotated[SQLAlchemyUoW, Depends(get_uow)] = ...,
 ) -> SearchOut:
-    data.text
+    generation, cached = await search_result_cache.get(data.text)
+    if cached is not None:
+        return SearchOut.model_validate(cached)
     async with uow:
-        docs = await uow.chat_repo.search_doc_in_vectordb(data.text)
+        hits, degraded = await uow.chat_repo.search_docs(data.text)
         doc_origins_out = [
-            DocOriginOut(
+            SearchHitOut(
                 id=doc.id,
                 is_archive=doc.is_archive,
                 content=doc.content,
                 created_at=doc.created_at,
-                updated_at=doc.updated_at
+                updated_at=doc.updated_at,
+                score=score,
             )
-            for doc in docs
+            for doc, score in hits
         ]
-    return SearchOut(doc_origins=doc_origins_out)
+    search_out = SearchOut(doc_origins=doc_origins_out)
+    # Lexical-only results are not cached, the next request tries the vector leg again
+    if not degraded:
+        await search_result_cache.set(data.text, generation, search_out.model_dump(mode="json"))
+    return search_out
 
 
 @router.post("/markdown-to-pdf")
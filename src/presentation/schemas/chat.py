@@ -23,7 +23,7 @@ class ChatOut(BaseModel):
     id: UUID4
     title: str | None
     created_at: datetime
-    image_url: str
+    image_url: str | None
     doc_versions: list[DocVersionOut]
     messages: list[MessageOut]
 
@@ -36,3 +36,6 @@ class NewMessageOut(BaseModel):
     content: str
     new_doc_version_id: str | None = None
 
+
+class JobOut(BaseModel):
+    job_id: str
@@ -30,8 +30,12 @@ class DocOriginOut(BaseModel):
     updated_at: datetime
 
 
+class SearchHitOut(DocOriginOut):
+    score: float | None = None
+
+
 class SearchOut(BaseModel):
-    doc_origins: list[DocOriginOut]
+    doc_origins: list[SearchHitOut]
 
 
 class SaveIn(BaseModel):
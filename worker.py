@@ -0,0 +1,66 @@
+"""Job worker: runs the OCR and rewrite jobs the web workers enqueue.
+
+    python worker.py                  # run until SIGTERM / SIGINT
+    python worker.py --requeue-dead   # put dead-lettered jobs back on the queue
+"""
+import argparse
+import asyncio
+import signal
+
+from loguru import logger
+
+from src.application.chatgpt import rewrite_doc
+from src.application.jobs import JobType, JobWorker, job_queue
+from src.application.pages import ocr_uploaded_doc, retry_failed_pages
+from src.application.streaming import abort_stream
+from src.infrastructure.lifespan import app_lifespan, lifespan_redis, lifespan_s3, lifespan_image_preprocessor
+from config import settings
+
+
+async def close_stream(doc_version_id: str, **kwargs) -> None:
+    await abort_stream(doc_version_id)
+
+
+JOB_TYPES = {
+    "ocr": JobType(
+        ocr_uploaded_doc,
+        concurrency=settings.JOB_OCR_CONCURRENCY,
+        on_dead=close_stream,
+    ),
+    "rewrite": JobType(
+        rewrite_doc,
+        concurrency=settings.JOB_REWRITE_CONCURRENCY,
+        on_dead=close_stream,
+    ),
+    "retry_pages": JobType(retry_failed_pages, concurrency=settings.JOB_OCR_CONCURRENCY),
+}
+
+
+async def run() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with app_lifespan([lifespan_redis, lifespan_s3, lifespan_image_preprocessor])(None):
+        worker = JobWorker(job_queue, JOB_TYPES)
+        worker.start()
+        await stop.wait()
+        logger.info("Stopping job worker")
+        await worker.stop()
+
+
+async def requeue_dead() -> None:
+    async with app_lifespan([lifespan_redis])(None):
+        count = await job_queue.requeue_dead()
+    logger.info(f"Requeued {count} dead jobs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requeue-dead", action="store_true", help="requeue dead-lettered jobs and exit")
+    args = parser.parse_args()
+    asyncio.run(requeue_dead() if args.requeue_dead else run())
+
+
+if __name__ == "__main__":
+    main()